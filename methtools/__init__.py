@@ -3,29 +3,34 @@
 
 import argparse
 import sys
-from methtools.plot import main as plot_main
-from methtools.destrand import main as destrand_main
-from methtools.tiling import main as tiling_main
-from methtools.filter import main as filter_main
-from methtools.dmr import main as dmr_main
-from methtools.calling import main as calling_main
 
 def main():
     toolname = sys.argv[1].strip().lower()
     del sys.argv[1]
 
+    # the tools are imported on demand, so that the modules can be imported
+    # without the dependencies of all tools, e.g. matplotlib for plot
     if toolname == 'plot':
+        from methtools.plot import main as plot_main
         plot_main()
     elif toolname == 'destrand':
+        from methtools.destrand import main as destrand_main
         destrand_main()
     elif toolname == 'tiling':
+        from methtools.tiling import main as tiling_main
         tiling_main()
     elif toolname == 'dmr':
+        from methtools.dmr import main as dmr_main
         dmr_main()
     elif toolname == 'filter':
+        from methtools.filter import main as filter_main
         filter_main()
     elif toolname == 'calling':
+        from methtools.calling import main as calling_main
         calling_main()
+    elif toolname == 'genome':
+        from methtools.genome import main as genome_main
+        genome_main()
 
 if __name__ == '__main__':
     main()
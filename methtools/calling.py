@@ -9,6 +9,7 @@ import numpy as np
 import multiprocessing
 import tempfile
 import shutil
+from methtools.genome import genome_header
 
 """
     The standard output is BED6 format, unless the option --methylkit is given.
@@ -362,8 +363,15 @@ def calling( options ):
     unknown_out = None
     min_cov = options.min_cov
 
+    header = ''
+    if options.genome_header:
+        samfile = pysam.Samfile( options.input_path, 'rb' )
+        header = genome_header( samfile.references, samfile.lengths )
+        samfile.close()
+
     if options.CpG:
         out = open( options.CpG, 'wb+')
+        out.write( header )
         if options.is_header:
             if options.is_methylkit:
                 out.write( "chrBase\tchr\tbase\tstrand\tcoverage\tfreqC\tfreqT\n" )
@@ -372,6 +380,7 @@ def calling( options ):
 
     if options.CHH:
         CHH_out = open( options.CHH, 'wb+' )
+        CHH_out.write( header )
         if options.is_header:
             if options.is_methylkit:
                 CHH_out.write( "chrBase\tchr\tbase\tstrand\tcoverage\tfreqC\tfreqT\n" )
@@ -380,6 +389,7 @@ def calling( options ):
 
     if options.CHG:
         CHG_out =  open( options.CHG, 'wb+' )
+        CHG_out.write( header )
         if options.is_header:
             if options.is_methylkit:
                 CHG_out.write( "chrBase\tchr\tbase\tstrand\tcoverage\tfreqC\tfreqT\n" )
@@ -388,6 +398,7 @@ def calling( options ):
 
     if options.unknown:
         unknown_out =  open( options.unknown, 'wb+' )
+        unknown_out.write( header )
         if options.is_header:
             if options.is_methylkit:
                 unknown_out.write( "chrBase\tchr\tbase\tstrand\tcoverage\tfreqC\tfreqT\n" )
@@ -549,6 +560,9 @@ def main():
     parser.add_argument("--header", dest="is_header", action="store_true", default=False,
                     help="Print header into the output file.")
 
+    parser.add_argument("--genome-header", dest="genome_header", action="store_true", default=False,
+                    help="Write the chromosome sizes of the BAM header as #genome lines into the output files, tiling can use them instead of a genome file.")
+
     parser.add_argument("--readlen", default=100, type=int,
                     help="Read length (default:100)")
 
@@ -45,6 +45,10 @@ def merge(sample, outfile, keep_positions = False):
     previouse_side = None
     merged_counter = 0
     for sample_line in sample:
+        # header lines, e.g. the #genome lines of calling.py --genome-header, are kept
+        if sample_line.startswith('#'):
+            outfile.write(sample_line)
+            continue
         if not previouse_side:
             previouse_side = sample_line
             continue
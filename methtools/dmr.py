@@ -5,53 +5,78 @@ import os, sys
 import argparse
 import numpy as np
 import tempfile
+import shutil
+import itertools
+import multiprocessing
+import StringIO
 from itertools import izip
-from scipy import stats
+from methtools.filter import fisher_pvalues
+from methtools.intervals import IntervalIndex, annotation_argument
+from methtools.sites import SiteBlock, intersected_blocks, joined_blocks, read_chrom_order, read_range, chromosome_ranges, WorkerExit, exit_in_parent
 
-try:
-    import fisher as fisher_exact
-except:
-    print 'The much faster fisher library is not installed. Fallback to scipy.'
+# the last-n check sums up the methylation deltas as integers in units of
+# 1/DELTA_SCALE %, that is exact for the two decimals written by calling.py,
+# the means of pooled replicates are rounded to six decimals
+DELTA_SCALE = 10**6
 
 
-class CpG():
-    def __init__(self, chrom, start, end, strand):
-        # cpg properties
+class ChromSites():
+    """
+        All aligned methylation sites of one chromosome, stored as parallel
+        arrays instead of one object per site. Windows refer to index ranges
+        of these arrays.
+    """
+    def __init__(self, chrom, start, end, cov_control, meth_control, cov_affected, meth_affected):
         self.chrom = chrom
         self.start = start
         self.end = end
-        self.strand = strand
-        self.cov_control = 0.0
-        self.meth_control = 0.0
-        self.cov_affected = 0.0
-        self.meth_affected = 0.0
-        self.delta = 0.0
-        self.weighted_methylation_control = 0.0
-        self.weighted_methylation_affected = 0.0
+        self.cov_control = cov_control
+        self.meth_control = meth_control
+        self.cov_affected = cov_affected
+        self.meth_affected = meth_affected
+        self.delta = meth_affected - meth_control
+        # python lists for the fast scalar access during the window scan
+        self.delta_values = self.delta.tolist()
+        self.end_values = end.tolist()
+        # fixed-point deltas for the exact last-n sums
+        self.delta_units = np.round( self.delta * DELTA_SCALE ).astype( np.int64 ).tolist()
+
+    def __len__(self):
+        return len(self.start)
 
     def __repr__(self):
-        return '%s\t%s\t%s control(c:%s, m:%s) affected(c:%s, m:%s) delta:%s' % (self.chrom, 
-            self.start, self.strand, 
-            self.cov_control, self.meth_control, self.cov_affected, 
-            self.meth_affected, self.delta)
-
-    def add_control(self, cov, meth):
-        # if the cpg site does not fullfil the requirements, we add a zero one and increase the skip counter
-        # that is necessary to not decrease the mean methylation state but be able to count these site as stopping criteria
-        # if skip is already set, than the other sample failed already and we should set all values to null
-        self.cov_control = cov
-        self.meth_control = meth
-        self._calculate_delta()
-        self.weighted_methylation_control = meth * cov
-
-    def add_affected(self, cov, meth):
-        self.cov_affected = cov
-        self.meth_affected = meth
-        self._calculate_delta()
-        self.weighted_methylation_affected = meth * cov
-
-    def _calculate_delta(self):
-        self.delta = self.meth_affected - self.meth_control
+        return 'ChromSites: %s with %s methylation sites' % (self.chrom, len(self))
+
+
+def chromosome_sites(blocks):
+    """
+        Arguments:
+            blocks -- iterator over aligned (control, affected) SiteBlock pairs
+
+        Return:
+            iterator over ChromSites objects, one for each chromosome
+
+        Windows never span chromosomes, so only the sites of one chromosome
+        are kept in memory.
+    """
+    chrom = None
+    parts = list()
+    for control, affected in blocks:
+        high = 0
+        for block_chrom, group in itertools.groupby( control.chrom ):
+            low, high = high, high + len( list(group) )
+            if block_chrom != chrom and parts:
+                yield _concatenate_sites( chrom, parts )
+                parts = list()
+            chrom = block_chrom
+            parts.append( (control.start[low:high], control.end[low:high], control.cov[low:high], control.meth[low:high], affected.cov[low:high], affected.meth[low:high]) )
+    if parts:
+        yield _concatenate_sites( chrom, parts )
+
+
+def _concatenate_sites(chrom, parts):
+    columns = [np.concatenate( column ) for column in izip( *parts )]
+    return ChromSites( str(chrom), *columns )
 
 
 class Window():
@@ -59,8 +84,10 @@ class Window():
         Defines a window of differential methylated CpG sites.
         Such a window will start with a min_size and grow dynamically until a 
         treshold is undercuted.
+        The CpG sites of a window are the index range first to last of the
+        sites of one chromosome.
     """
-    def __init__(self, min_window_length = 4, max_cpg_distance = None, min_delta_methylation = 25, last_n = 4, allow_failed = None, options = None):
+    def __init__(self, sites, min_window_length = 4, max_cpg_distance = None, min_delta_methylation = 25, last_n = 4, allow_failed = None, options = None):
         # constraints
         self.min_window_length = min_window_length
         self.max_cpg_distance = max_cpg_distance
@@ -69,12 +96,21 @@ class Window():
         self.last_n = last_n # check last n postitions ot the cpgs if they are over min_delta_methylation
         self.allow_failed = allow_failed
         # window properties
-        self.chrom = None
+        self.sites = sites
+        self.deltas = sites.delta_values
+        self.units = sites.delta_units
+        self.chrom = sites.chrom
         self.start = None
         self.end = None
-        self.cpgs = list()
+        self.first = None
+        self.last = None
         self.window_length = 0
         self.delta_sum = 0.0
+        # exact sum and number of the last last_n-1 deltas and failed sites of the last allow_failed sites
+        self.last_sum = 0
+        self.last_count = 0
+        self.last_failed = 0
+        self.min_delta_units = int( round( min_delta_methylation * DELTA_SCALE ) )
 
         # save intermediate results for methylation calculation
         self.delta = 0.0
@@ -85,155 +121,190 @@ class Window():
     def __repr__(self):
         return 'Window: %s - %s, %s methylation sites and %s%% methylation.' % (self.start, self.end, self.window_length, self.delta)
 
-    def _check_cpg(self, cpg):
+    def _check_cpg(self, index):
         """
             Ordering of the evalutation is crucial
         """
+        delta = self.deltas[ index ]
         # if that is 0, than wen add the first site and we should skip the distance check
-        last_site_position_end = self.get_last_cpg()
-        if last_site_position_end != []:
-            last_site_position_end = last_site_position_end.end
-            if self.max_cpg_distance and (cpg.end - last_site_position_end) > self.max_cpg_distance:
-                #print 'kick: max_cpg_distance', (cpg.end - self.get_last_cpg().end), cpg.end, - self.get_last_cpg().end, self.max_cpg_distance
+        if self.window_length:
+            if self.max_cpg_distance and (self.sites.end_values[ index ] - self.end) > self.max_cpg_distance:
                 return False
 
         # check if the delta of methylated CpGs is not larger than self.min_single_delta_methylation
         # take hyper or hypo from the windows into account
         if self.min_single_delta_methylation != None:
             # hypo, the delta from the windows is negativ (affected - control)
-            if self.delta < 0 and cpg.delta > -self.min_single_delta_methylation:
+            if self.delta < 0 and delta > -self.min_single_delta_methylation:
                 return False
-            elif self.delta > 0 and cpg.delta < self.min_single_delta_methylation:
+            elif self.delta > 0 and delta < self.min_single_delta_methylation:
                 return False
-            #if abs(cpg.delta) < self.min_single_delta_methylation:
-            #    return False
 
         if len(self) + 1 < self.min_window_length:
             return True
 
-        # get the last_n cpg site from the current window, n-1 because we want to check with the new cpg site
+        # the failed sites and the delta sum of the last n cpg sites are updated with each added site,
+        # n-1 because we want to check with the new cpg site
         if self.allow_failed != None:
-            if self.allow_failed == 0:
-                last_n_cpgs = list()
-            else:
-                last_n_cpgs = self.get_last_n_cpgs( self.allow_failed )
-            # add new cpg site to the end
-            last_n_cpgs.append(cpg)
-
-            failed_cpgs = 0
-            for test_cpg in last_n_cpgs:
-                if abs(test_cpg.delta) < self.min_delta_methylation:
-                    failed_cpgs += 1
+            failed_cpgs = self.last_failed
+            if abs(delta) < self.min_delta_methylation:
+                failed_cpgs += 1
             if failed_cpgs > self.allow_failed:
                 return False
 
         if self.last_n > 0:
-            last_n_cpgs = self.get_last_n_cpgs( self.last_n -1 )
-            last_n_cpgs.append(cpg)
-            # check the last n cpg sites if they are in the mean over the min_delta_methylation
-            if abs(self.calculate_window_methylation( last_n_cpgs )) < self.min_delta_methylation:
+            # check the last n cpg sites if they are in the mean over the min_delta_methylation,
+            # compared exactly in fixed-point integers: |sum| / count < min_delta_methylation
+            if abs( self.last_sum + self.units[ index ] ) < self.min_delta_units * (self.last_count + 1):
                 return False
 
         return True
 
-    def get_last_cpg(self):
+    def _update_last_n(self, index):
         """
-            returns the last cpg site
+            Adds the new site index to the sum of the last n-1 deltas and to
+            the failed counter of the last allow_failed sites, and removes
+            the sites that drop out of these ranges. The window is a
+            contiguous index range, so these sites are index - (last_n-1)
+            and index - allow_failed.
         """
-        try:
-            return self.cpgs[ -1 ]
-        except IndexError:
-            return []
-
-    def get_last_n_cpgs(self, n):
-        index = min( n, len(self) )
-        return self.cpgs[ len(self) - index : ]
-
-    def add_cpg(self, cpg):
-        if self._check_cpg( cpg ):
-            # only set if self.start is None, that is during the first cpg insert
-            if not self.start:
-                self.start = cpg.start
-                self.chrom = cpg.chrom
-                assert(self.start+1 == cpg.end)
-            self.end = cpg.end
-
-            self.cpgs.append(cpg)
+        delta = self.deltas[ index ]
+        if self.last_n > 0:
+            self.last_sum += self.units[ index ]
+            leaving = index - (self.last_n - 1)
+            if leaving >= self.first:
+                self.last_sum -= self.units[ leaving ]
+            else:
+                self.last_count += 1
+        if self.allow_failed:
+            if abs(delta) < self.min_delta_methylation:
+                self.last_failed += 1
+            leaving = index - self.allow_failed
+            if leaving >= self.first and abs(self.deltas[ leaving ]) < self.min_delta_methylation:
+                self.last_failed -= 1
+
+    def add_cpg(self, index):
+        if self._check_cpg( index ):
+            # only set if self.first is None, that is during the first cpg insert
+            if self.first is None:
+                self.first = index
+                self.start = int( self.sites.start[ index ] )
+            self._update_last_n( index )
+            self.last = index
+            self.end = self.sites.end_values[ index ]
+
             self.window_length += 1
-            self.delta_sum += cpg.delta
+            self.delta_sum += self.deltas[ index ]
             self.delta = self.delta_sum / len(self)
             return True
         else:
             return False
 
-    def calculate_window_methylation(self, cpgs):
+    def calculate_window_methylation(self, deltas):
         try:
-            return sum([cpg.delta for cpg in cpgs]) / len(cpgs)
+            return sum( deltas ) / len( deltas )
         except ZeroDivisionError:
             return 0.0
 
+    def fisher_counts(self, weighted = False):
+        """
+            Return:
+                (control coverage, control methylation, affected coverage, affected methylation)
+                of the pooled window, the input of filter.fisher_pvalues()
+        """
+        sites = self.sites
+        index = slice( self.first, self.last + 1 )
+        if weighted:
+            sum_meth_control = sum( (sites.meth_control[index] * sites.cov_control[index]).tolist() )
+            sum_meth_affected = sum( (sites.meth_affected[index] * sites.cov_affected[index]).tolist() )
+        else:
+            sum_meth_control = sum( sites.meth_control[index].tolist() )
+            sum_meth_affected = sum( sites.meth_affected[index].tolist() )
+        sum_cov_control = sum( sites.cov_control[index].tolist() )
+        sum_cov_affected = sum( sites.cov_affected[index].tolist() )
+        return sum_cov_control, sum_meth_control / sum_cov_control, sum_cov_affected, sum_meth_affected / sum_cov_affected
+
     def calculate_differential_methylation_fisher_exact(self, weighted = False):
-        sum_meth_control = 0
-        sum_meth_affected = 0
-        sum_cov_control = 0
-        sum_cov_affected = 0
-        for cpg in self.cpgs:
-            if weighted:
-                sum_meth_control += cpg.weighted_methylation_control
-                sum_meth_affected += cpg.weighted_methylation_affected
-                sum_cov_control += cpg.cov_control
-                sum_cov_affected += cpg.cov_affected
-            else:
-                sum_meth_control += cpg.meth_control
-                sum_meth_affected += cpg.meth_affected
-                sum_cov_control += cpg.cov_control
-                sum_cov_affected += cpg.cov_affected
-
-        control = sum_meth_control / sum_cov_control
-        affected = sum_meth_affected / sum_cov_affected
-        control_methylated = sum_cov_control * control / 100
-        control_unmethylated = sum_cov_control - control_methylated
-        affected_methylated = sum_cov_affected * affected / 100
-        affected_unmethylated = sum_cov_affected - affected_methylated
-        try:
-            #Try to use the much faster fisher module from http://pypi.python.org/pypi/fisher/
-            p = fisher_exact.pvalue(control_methylated, control_unmethylated, affected_methylated, affected_unmethylated)
-            pvalue = p.two_tail
-        except:
-            oddsratio, pvalue = stats.fisher_exact([(control_methylated, control_unmethylated), (affected_methylated, affected_unmethylated)], alternative='two-sided')
-        return pvalue
+        return window_pvalues( [self], weighted )[0]
 
 
     def strip_cpgs(self):
-        # left strip
-        lstrip = []
-        while self.cpgs:
-            # remove from the left end of the list all bad methylation sites
-            # if the first good site is encounterd, leave the loop
-            if abs(self.cpgs[0].delta) < self.min_delta_methylation:
-                #print 'lstrip', self.cpgs[0]
-                lstrip.append( self.cpgs.pop(0) )
-            else:
-                break
-        # right strip
-        rstrip = []
-        while self.cpgs:
-            # remove from the right end of the list all bad methylation sites
-            # if the first good site is encounterd, leave the loop
-            if abs(self.cpgs[-1].delta) < self.min_delta_methylation:
-                #print 'rstrip', self.cpgs[-1]
-                rstrip.append( self.cpgs.pop() )
+        """
+            Removes all poor methylation sites from both ends of the window by
+            moving the first and last index.
+            Returns the number of removed sites on the left and on the right end.
+        """
+        if not self.window_length:
+            return 0, 0
+        first = self.first
+        last = self.last
+        # remove from the left end all bad methylation sites
+        # if the first good site is encounterd, leave the loop
+        while first <= last and abs(self.deltas[ first ]) < self.min_delta_methylation:
+            first += 1
+        # remove from the right end all bad methylation sites
+        while last >= first and abs(self.deltas[ last ]) < self.min_delta_methylation:
+            last -= 1
+        lstrip = first - self.first
+        rstrip = self.last - last
+        if lstrip or rstrip:
+            # only the stripped sites are subtracted from the window sum, that costs O(stripped sites)
+            for index in xrange( self.first, first ):
+                self.delta_sum -= self.deltas[ index ]
+            for index in xrange( last + 1, self.last + 1 ):
+                self.delta_sum -= self.deltas[ index ]
+            self.first = first
+            self.last = last
+            self.window_length = last - first + 1
+            if self.window_length:
+                self.delta = self.delta_sum / self.window_length
+                self.start = int( self.sites.start[ first ] )
+                self.end = self.sites.end_values[ last ]
             else:
-                break
-        if rstrip or lstrip:
-            self.delta = self.calculate_window_methylation(self.cpgs)
-            # it meight be faster to substract the lstrip and rstrip objects from skip_sites
-            self.window_length = len(self.cpgs)
-            self.start = self.cpgs[0].start
-            self.end = self.cpgs[-1].end
+                self.delta_sum = 0.0
+                self.delta = 0.0
         return lstrip, rstrip
 
-    def write_to_bed_string(self, fisher = False, hyper = False, hypo = False):
+    def merge(self, other, merge_gap = None, merge_cpg_gap = None):
+        """
+            Arguments:
+                other -- the following DMR of the same chromosome
+                merge_gap -- maximal distance in bp between both windows
+                merge_cpg_gap -- maximal number of sites between both windows
+
+            Return:
+                True if other was merged into this window
+
+            Both windows are merged if they have the same direction (hyper or
+            hypo), are within the given gaps and the merged window, including
+            the sites between both windows, still has the minimal delta.
+        """
+        if (self.delta > 0) != (other.delta > 0):
+            return False
+        if merge_gap is not None and other.start - self.end > merge_gap:
+            return False
+        if merge_cpg_gap is not None and other.first - self.last - 1 > merge_cpg_gap:
+            return False
+
+        delta_sum = self.delta_sum
+        for index in xrange( self.last + 1, other.first ):
+            delta_sum += self.deltas[ index ]
+        delta_sum += other.delta_sum
+        window_length = other.last - self.first + 1
+        if abs( delta_sum / window_length ) < self.min_delta_methylation:
+            return False
+
+        self.delta_sum = delta_sum
+        self.window_length = window_length
+        self.delta = delta_sum / window_length
+        self.last = other.last
+        self.end = other.end
+        return True
+
+    def is_dmr(self, hyper = False, hypo = False):
+        """
+            Strips the window and checks if it is reported as DMR.
+        """
         self.strip_cpgs()
         if len(self) < self.min_window_length:
             return False
@@ -245,16 +316,22 @@ class Window():
             return False
         if hyper and self.delta < 0:
             return False
+        return True
 
-        ret = "%s\t%s\t%s\t%s\t%s\t%s\t%s" % (self.chrom, self.start, self.end, self.window_length, self.delta, 0, self.end - self.start)
-        if fisher:
-            pvalue = self.calculate_differential_methylation_fisher_exact()
-            ret += '\t%e' % pvalue
-            pvalue = self.calculate_differential_methylation_fisher_exact( weighted = True )
-            ret += '\t%e\n' % pvalue
-        else:
-            ret += '\n'
-        return ret
+    def score(self):
+        """
+            Summed absolute methylation difference of the window, used to rank
+            the DMRs for the empirical FDR.
+        """
+        return abs( self.delta ) * self.window_length
+
+    def bed_string(self):
+        return "%s\t%s\t%s\t%s\t%s\t%s\t%s" % (self.chrom, self.start, self.end, self.window_length, self.delta, 0, self.end - self.start)
+
+    def write_to_bed_string(self, fisher = False, hyper = False, hypo = False):
+        if not self.is_dmr( hyper, hypo ):
+            return False
+        return ''.join( bed_lines( [self], fisher ) )
 
     def write_to_bed_file(self, handle, fisher = False, hyper = False, hypo = False):
         text = self.write_to_bed_string(fisher, hyper, hypo)
@@ -262,55 +339,464 @@ class Window():
             handle.write( text )
 
 
+def scan_chromosome(sites, options):
+    """
+        Arguments:
+            sites -- ChromSites of one chromosome
+            options -- dmr options with the window constraints
+
+        Return:
+            iterator over all windows with at least options.min_window_length sites
+    """
+    def new_window():
+        return Window(sites, options.min_window_length, options.max_cpg_distance, options.min_delta_methylation, options.check_last_n, options.allow_failed, options)
+
+    win = new_window()
+    for index in xrange( len(sites) ):
+        if not win.add_cpg( index ):
+            if len(win) >= options.min_window_length:
+                yield win
+
+            # create a new window and try to add the CpG that is responsible for the abort, as new starting
+            win = new_window()
+            if not win.add_cpg( index ):
+                win = new_window()
+
+    # write the last window of the chromosome
+    if len(win) >= options.min_window_length:
+        yield win
+
+
+def merge_windows(windows, merge_gap = None, merge_cpg_gap = None):
+    """
+        Arguments:
+            windows -- iterator over the DMRs of one chromosome
+            merge_gap, merge_cpg_gap -- see Window.merge()
+
+        Return:
+            iterator over the DMRs, where neighbouring DMRs are merged. Only
+            the last DMR is held back until the next one is known.
+    """
+    last = None
+    for win in windows:
+        if last is not None and last.merge( win, merge_gap, merge_cpg_gap ):
+            continue
+        if last is not None:
+            yield last
+        last = win
+    if last is not None:
+        yield last
+
+
+def dmr_windows(sites, options):
+    """
+        Returns an iterator over all DMRs of one chromosome, merged if
+        --merge-gap or --merge-cpg-gap is set. The DMRs are merged before
+        the --hyper and --hypo selection, so that a DMR of the other
+        direction still separates its neighbours.
+    """
+    windows = (win for win in scan_chromosome( sites, options ) if win.is_dmr())
+    if options.merge_gap is not None or options.merge_cpg_gap is not None:
+        windows = merge_windows( windows, options.merge_gap, options.merge_cpg_gap )
+    if options.hyper or options.hypo:
+        windows = (win for win in windows if win.is_dmr( options.hyper, options.hypo ))
+    return windows
+
+
+def window_pvalues(windows, weighted = False):
+    """
+        Returns an array with the fisher exact test pvalue of each window, all
+        windows are tested with one call of filter.fisher_pvalues().
+    """
+    counts = np.array( [win.fisher_counts( weighted ) for win in windows], dtype = float ).reshape( -1, 4 )
+    return fisher_pvalues( *counts.T )
+
+
+def bed_lines(windows, fisher = False, annotations = None):
+    """
+        Arguments:
+            windows -- list of DMRs
+            fisher -- append the unweighted and the weighted fisher exact test pvalue
+            annotations -- list of IntervalIndex objects, the annotation columns of each are appended
+
+        Return:
+            iterator over the BED lines of the windows
+    """
+    columns = [[win.bed_string()] for win in windows]
+    if fisher:
+        for row, pvalue, weighted_pvalue in izip( columns, window_pvalues( windows ), window_pvalues( windows, weighted = True ) ):
+            row.append( '%e\t%e' % (pvalue, weighted_pvalue) )
+    for index in annotations or []:
+        for row, win in izip( columns, windows ):
+            row.append( index.annotate( win.chrom, win.start, win.end ) )
+    for row in columns:
+        yield '\t'.join( row ) + '\n'
+
+
+def call_chromosome(sites, options, handle):
+    """
+        Writes all DMRs of one chromosome to handle and returns the written windows.
+        The DMRs are collected per chromosome, so the fisher pvalues are
+        calculated in one batch.
+    """
+    written = list( dmr_windows( sites, options ) )
+    handle.writelines( bed_lines( written, options.fisher, options.annotation_indexes ) )
+    return written
+
+
+def permuted_sites(sites, mode, random_state):
+    """
+        Arguments:
+            sites -- ChromSites of one chromosome
+            mode -- 'label': swap control and affected of each site with probability 0.5
+                    'shuffle': shuffle the methylation values of both samples over the sites
+            random_state -- numpy RandomState
+
+        Return:
+            ChromSites with the same positions and permuted methylation values
+    """
+    cov_control = np.array( sites.cov_control )
+    meth_control = np.array( sites.meth_control )
+    cov_affected = np.array( sites.cov_affected )
+    meth_affected = np.array( sites.meth_affected )
+    if mode == 'label':
+        swap = random_state.rand( len(sites) ) < 0.5
+        cov_control[swap], cov_affected[swap] = cov_affected[swap], cov_control[swap]
+        meth_control[swap], meth_affected[swap] = meth_affected[swap], meth_control[swap]
+    else:
+        order = random_state.permutation( len(sites) )
+        cov_control, meth_control = cov_control[order], meth_control[order]
+        cov_affected, meth_affected = cov_affected[order], meth_affected[order]
+    return ChromSites( sites.chrom, sites.start, sites.end, cov_control, meth_control, cov_affected, meth_affected )
+
+
+@exit_in_parent
+def run_permutation( args ):
+    """
+        Multiprocessing helper function.
+        Scans all stored chromosomes with permuted methylation values and
+        returns the scores of all DMRs found in that null data set.
+    """
+    options, stored, seed = args
+    random_state = np.random.RandomState( seed )
+    scores = list()
+    for chrom, prefix in stored:
+        sites = permuted_sites( load_sites(chrom, prefix), options.permutation_mode, random_state )
+        scores.extend( win.score() for win in dmr_windows( sites, options ) )
+    return np.array( scores, dtype = float )
+
+
+def empirical_qvalues(scores, null_scores, permutations):
+    """
+        Arguments:
+            scores -- scores of the observed DMRs
+            null_scores -- scores of all DMRs of all permutations
+            permutations -- number of permutations
+
+        Return:
+            q-value of each observed DMR, the mean number of null DMRs with at
+            least the same score divided by the number of observed DMRs with at
+            least that score, made monotone in the score.
+
+        >>> empirical_qvalues([10, 20, 30], [5, 15, 15, 25], 2).tolist()
+        [0.5, 0.25, 0.0]
+    """
+    scores = np.asarray( scores, dtype = float )
+    null_scores = np.sort( null_scores )
+    order = np.argsort( scores, kind = 'mergesort' )
+    sorted_scores = scores[order]
+    observed = len(scores) - np.searchsorted( sorted_scores, sorted_scores, side = 'left' )
+    expected = ( len(null_scores) - np.searchsorted( null_scores, sorted_scores, side = 'left' ) ) / float( permutations )
+    fdr = np.minimum( expected / observed, 1.0 )
+    qvalues = np.empty( len(scores) )
+    qvalues[order] = np.minimum.accumulate( fdr )
+    return qvalues
+
+
+def permutation_fdr(options):
+    """
+        Calls the DMRs and estimates their FDR by repeating the window scan
+        --permutations times on permuted data. The input is parsed only once,
+        the permutations are distributed over a process pool and use the
+        seeds --seed, --seed + 1, ... so the result does not depend on the
+        number of processes. Each DMR gets an additional q-value column.
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        stored = store_sites( options, temp_dir )
+
+        worker_options = argparse.Namespace( **vars(options) )
+        worker_options.outfile = None
+        lines = list()
+        scores = list()
+        for chrom, prefix in stored:
+            windows = list( dmr_windows( load_sites(chrom, prefix), worker_options ) )
+            lines.extend( line.rstrip('\n') for line in bed_lines( windows, options.fisher, options.annotation_indexes ) )
+            scores.extend( win.score() for win in windows )
+
+        jobs = [(worker_options, stored, options.seed + index) for index in xrange( options.permutations )]
+        if options.processors > 1:
+            pool = multiprocessing.Pool( options.processors )
+            try:
+                null_scores = pool.map( run_permutation, jobs )
+            finally:
+                # the pool is terminated as well if a worker exits
+                pool.terminate()
+                pool.join()
+        else:
+            null_scores = map( run_permutation, jobs )
+    finally:
+        # cleaning temporary working directory
+        shutil.rmtree( temp_dir )
+
+    qvalues = empirical_qvalues( scores, np.concatenate( null_scores + [np.zeros(0)] ), options.permutations )
+    for line, qvalue in izip( lines, qvalues ):
+        options.outfile.write( '%s\t%e\n' % (line, qvalue) )
+
+
+def pool_group(blocks, group_methylation = 'weighted'):
+    """
+        Arguments:
+            blocks -- SiteBlocks of the replicates of one group, all with the same sites
+            group_methylation -- 'weighted': coverage-weighted mean of the replicates
+                                 'mean': mean of the replicates
+
+        Return:
+            one SiteBlock with the summed coverage and the group methylation
+    """
+    if len(blocks) == 1:
+        return blocks[0]
+    covs = np.array( [block.cov for block in blocks] )
+    meths = np.array( [block.meth for block in blocks] )
+    cov = covs.sum( axis = 0 )
+    meth = meths.mean( axis = 0 )
+    if group_methylation == 'weighted':
+        # sites without any coverage keep the plain mean
+        covered = cov > 0
+        meth[covered] = (covs * meths).sum( axis = 0 )[covered] / cov[covered]
+    first = blocks[0]
+    return SiteBlock( first.lines, (first.chrom, first.start, first.end, cov, meth, first.strand) )
+
+
+def site_blocks(options, control_ranges = None, affected_ranges = None):
+    """
+        Returns an iterator over aligned (control, affected) SiteBlock pairs,
+        optionally restricted to byte ranges of the input files. The
+        replicates of each group are pooled to one SiteBlock.
+    """
+    paths = options.control + options.affected
+    ranges = (control_ranges or [None] * len(options.control)) + (affected_ranges or [None] * len(options.affected))
+    handles = [read_range( path, byte_range ) for path, byte_range in izip( paths, ranges )]
+    if options.join:
+        chrom_order = None
+        if options.chrom_order:
+            chrom_order = read_chrom_order( options.chrom_order )
+        blocks = joined_blocks( handles, chrom_order )
+    else:
+        blocks = intersected_blocks( handles )
+
+    controls = len(options.control)
+    for group_blocks in blocks:
+        yield pool_group( group_blocks[:controls], options.group_methylation ), pool_group( group_blocks[controls:], options.group_methylation )
+
+
+@exit_in_parent
+def run_chromosome( args ):
+    """
+        Multiprocessing helper function.
+        Calls the DMRs of one chromosome and returns them as BED formatted string.
+    """
+    options, chrom, control_ranges, affected_ranges = args
+    handle = StringIO.StringIO()
+    for sites in chromosome_sites( site_blocks(options, control_ranges, affected_ranges) ):
+        if sites.chrom != chrom:
+            sys.exit('The sites of the chromosome %s are not consecutive in the input files. Please sort the files.' % chrom)
+        call_chromosome( sites, options, handle )
+    return handle.getvalue()
+
+
 def dmr(options):
 
-    win = Window(options.min_window_length, options.max_cpg_distance, options.min_delta_methylation, options.check_last_n, options.allow_failed, options)
-    old_chrom = False
+    options.annotation_indexes = [IntervalIndex( path, name ) for name, path in options.annotate]
 
-    for control, affected in izip(open(options.control), open(options.affected)):
-        c_chrom, c_start, c_end, c_cov, c_meth, c_strand = control.strip().split('\t')
-        a_chrom, a_start, a_end, a_cov, a_meth, a_strand = affected.strip().split('\t')
-        try:
-            assert( c_chrom == a_chrom )
-            assert( c_start == a_start )
-            assert( c_end == a_end )
-            assert( c_strand == a_strand )
-        except AssertionError:
-            raise
+    if options.sweep and options.permutations:
+        sys.exit('--sweep and --permutations can not be combined.')
 
-        c_cov, c_meth, a_cov, a_meth = map(float, [c_cov, c_meth, a_cov, a_meth])
+    if options.sweep:
+        sweep( options )
+    elif options.permutations:
+        permutation_fdr( options )
+    elif options.processors > 1:
+        """
+            Windows never span chromosomes, so each chromosome is processed
+            on its own. The chromosomes are located with a binary search in
+            all files and the DMRs are written in the chromosome order of
+            the first control file.
+        """
+        file_ranges = [dict( chromosome_ranges( path ) ) for path in options.control + options.affected]
+        controls = len(options.control)
+        worker_options = argparse.Namespace( **vars(options) )
+        worker_options.outfile = None
+        jobs = list()
+        for chrom, control_range in chromosome_ranges( options.control[0] ):
+            if all( chrom in ranges for ranges in file_ranges ):
+                chrom_ranges = [ranges[chrom] for ranges in file_ranges]
+                jobs.append( (worker_options, chrom, chrom_ranges[:controls], chrom_ranges[controls:]) )
+
+        pool = multiprocessing.Pool( options.processors )
+        for text in pool.imap( run_chromosome, jobs ):
+            options.outfile.write( text )
+        pool.close()
+        pool.join()
+    else:
+        for sites in chromosome_sites( site_blocks(options) ):
+            call_chromosome( sites, options, options.outfile )
+
+
+SITE_COLUMNS = ('start', 'end', 'cov_control', 'meth_control', 'cov_affected', 'meth_affected')
+
+
+def store_sites(options, directory):
+    """
+        Arguments:
+            options -- dmr options with the input files
+            directory -- directory for the array files
 
-        if old_chrom and old_chrom != c_chrom:
-            # write window to the file if they fullfil the requirements
-            if len(win) >= options.min_window_length:
-                win.write_to_bed_file( options.outfile, options.fisher, options.hyper, options.hypo)
-            # init a new window
-            win = Window(options.min_window_length, options.max_cpg_distance, options.min_delta_methylation, options.check_last_n, options.allow_failed, options)
-
-        cpg = CpG( c_chrom, int(c_start), int(c_end), c_strand )
-        cpg.add_control( float(c_cov), float(c_meth) )
-        cpg.add_affected( float(a_cov), float(a_meth) )
-        if not win.add_cpg( cpg ):
-            if len(win) >= options.min_window_length:
-                win.write_to_bed_file( options.outfile, options.fisher, options.hyper, options.hypo)
+        Return:
+            list of (chromosome, path prefix) tuples in input order
+
+        Parses the input files once and stores the arrays of each chromosome
+        as .npy files, which can be memory-mapped by all worker processes.
+    """
+    stored = list()
+    for index, sites in enumerate( chromosome_sites( site_blocks(options) ) ):
+        prefix = os.path.join( directory, 'chrom%s' % index )
+        for column in SITE_COLUMNS:
+            np.save( '%s_%s.npy' % (prefix, column), getattr(sites, column) )
+        stored.append( (sites.chrom, prefix) )
+    return stored
+
+
+def load_sites(chrom, prefix):
+    """
+        Returns the memory-mapped ChromSites stored by store_sites().
+    """
+    return ChromSites( chrom, *[np.load('%s_%s.npy' % (prefix, column), mmap_mode='r') for column in SITE_COLUMNS] )
+
+
+def parameter_list(text, allow_none = False):
+    """
+        argparse type for a comma separated list of integers, with
+        allow_none 'none' means that the constraint is not checked.
+
+        >>> parameter_list('20,25, 30')
+        [20, 25, 30]
+        >>> parameter_list('none,500', allow_none = True)
+        [None, 500]
+    """
+    values = list()
+    for value in text.split(','):
+        value = value.strip()
+        if value.lower() == 'none':
+            if not allow_none:
+                raise argparse.ArgumentTypeError('none is not allowed for that parameter, it needs a value')
+            values.append( None )
+        else:
+            try:
+                values.append( int(value) )
+            except ValueError:
+                raise argparse.ArgumentTypeError('%s is not an integer' % value)
+    return values
+
+
+def optional_parameter_list(text):
+    """
+        argparse type for the parameters that can be disabled with 'none',
+        see parameter_list().
+    """
+    return parameter_list( text, allow_none = True )
 
-            # create a new window with, if we have remainings frome the previouse window, add these at start cpgs
-            win = Window(options.min_window_length, options.max_cpg_distance, options.min_delta_methylation, options.check_last_n, options.allow_failed, options)
-            # try to add the CpG that is responsible for the abort, as new starting 
-            # TODO
-            if not win.add_cpg( cpg ):
-                win = Window(options.min_window_length, options.max_cpg_distance, options.min_delta_methylation, options.check_last_n, options.allow_failed, options)
-        old_chrom = c_chrom
+
+def format_setting(value):
+    if value is None:
+        return 'none'
+    return str(value)
+
+
+@exit_in_parent
+def run_sweep( args ):
+    """
+        Multiprocessing helper function.
+        Calls the DMRs for one parameter setting on the stored arrays, writes
+        them to path and returns the summary of that setting.
+    """
+    options, stored, setting, path = args
+    options.min_delta_methylation, options.check_last_n, options.allow_failed, options.max_cpg_distance = setting
+    windows = list()
+    with open(path, 'w') as handle:
+        for chrom, prefix in stored:
+            windows.extend( (win.window_length, win.end - win.start, win.delta) for win in call_chromosome( load_sites(chrom, prefix), options, handle ) )
+
+    dmrs = len(windows)
+    hyper = sum( 1 for cpgs, length, delta in windows if delta > 0 )
+    cpgs = sum( cpgs for cpgs, length, delta in windows )
+    length = sum( length for cpgs, length, delta in windows )
+    mean_length = float(length) / dmrs if dmrs else 0.0
+    return '\t'.join( [format_setting(value) for value in setting] + map(str, [dmrs, hyper, dmrs - hyper, cpgs, length, mean_length, path]) ) + '\n'
+
+
+def sweep(options):
+    """
+        Evaluates all combinations of the --sweep-* parameter lists. The
+        input is parsed only once, each setting is written to its own file
+        and options.outfile gets a summary table with one line per setting.
+    """
+    values = [
+        options.sweep_min_delta_methylation or [options.min_delta_methylation],
+        options.sweep_check_last_n or [options.check_last_n],
+        options.sweep_allow_failed or [options.allow_failed],
+        options.sweep_max_cpg_distance or [options.max_cpg_distance],
+    ]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        stored = store_sites( options, temp_dir )
+
+        worker_options = argparse.Namespace( **vars(options) )
+        worker_options.outfile = None
+        jobs = list()
+        for setting in itertools.product( *values ):
+            path = '%s_delta%s_lastn%s_failed%s_distance%s.bed' % tuple( [options.sweep] + [format_setting(value) for value in setting] )
+            jobs.append( (argparse.Namespace( **vars(worker_options) ), stored, setting, path) )
+
+        options.outfile.write( '#min_delta_methylation\tcheck_last_n\tallow_failed\tmax_cpg_distance\tdmrs\thyper\thypo\tcpgs\ttotal_length\tmean_length\toutfile\n' )
+        if options.processors > 1:
+            pool = multiprocessing.Pool( options.processors )
+            try:
+                for line in pool.imap( run_sweep, jobs ):
+                    options.outfile.write( line )
+            finally:
+                # the pool is terminated as well if a worker exits
+                pool.terminate()
+                pool.join()
+        else:
+            for job in jobs:
+                options.outfile.write( run_sweep( job ) )
+    finally:
+        # cleaning temporary working directory
+        shutil.rmtree( temp_dir )
 
 
 def main():
     parser = argparse.ArgumentParser(description='Extract differential methylated regions.')
 
-    parser.add_argument("--control", required=True,
-                    help="Path to the control file.")
+    parser.add_argument("--control", required=True, nargs='+',
+                    help="Path to the control file, or the files of all control replicates.")
+
+    parser.add_argument("--affected", required=True, nargs='+',
+                    help="Path to the affected file, or the files of all affected replicates.")
 
-    parser.add_argument("--affected", required=True,
-                    help="Path to the affected file.")
+    parser.add_argument("--group-methylation", dest="group_methylation", choices=['weighted', 'mean'], default='weighted',
+                    help="Methylation of a group with several replicates, the coverage-weighted mean or the mean of the replicates. The coverage of a group is the sum of the replicates (default: weighted)")
 
     parser.add_argument('-o', '--outfile', type=argparse.FileType('w'),
                      default=sys.stdout)
@@ -333,14 +819,51 @@ def main():
     parser.add_argument("--max-cpg-distance", dest="max_cpg_distance", default=None, type=int,
                     help="maximal CpG distance (default:None)")
 
+    parser.add_argument('-p', '--processors', type=int, default=1,
+                    help="Number of processes, the chromosomes are processed in parallel (default:1)")
+
+    parser.add_argument("--join", action='store_true', default=False,
+                    help="The input files are not intersected. Join them on the fly, both files need to be sorted by chromosome and start position.")
+
+    parser.add_argument("--chrom-order", dest="chrom_order", default=None,
+                    help="File with the chromosome sort order of the input files in the first column, e.g. a genome file (default: lexicographic order)")
+
     parser.add_argument('--fisher', action='store_true', default=False, help='Calculate the pvalue of each window with a fisher-exact-test')
 
     parser.add_argument('--hyper', action='store_true', default=False, help='Output only hyper methylated DMRs.')
     parser.add_argument('--hypo', action='store_true', default=False, help='Output only hypo methylated DMRs.')
 
 
+    parser.add_argument("--merge-gap", dest="merge_gap", metavar='BP', default=None, type=int,
+                    help="Merge neighbouring DMRs with the same direction (hyper/hypo) that are at most BP apart, "
+                    "if the merged DMR including the sites in between has the minimal delta (default: no merging)")
+
+    parser.add_argument("--merge-cpg-gap", dest="merge_cpg_gap", metavar='N', default=None, type=int,
+                    help="Merge neighbouring DMRs with the same direction that have at most N sites in between, see --merge-gap (default: no merging)")
+
+    parser.add_argument('--annotate', metavar='NAME=BED', type=annotation_argument, action='append', default=[],
+                    help='Annotate the DMRs with the features of a BED file (name in the 4th column), can be given multiple times. '
+                    'For each file three columns are appended: overlapping features, nearest feature and its distance.')
+
+    group = parser.add_argument_group('empirical FDR', 'Repeat the window scan on permuted data and append an empirical q-value column to each DMR.')
+    group.add_argument('--permutations', metavar='N', type=int, default=0, help='Number of permutations (default: 0, no FDR estimation)')
+    group.add_argument('--permutation-mode', dest='permutation_mode', choices=['label', 'shuffle'], default='label',
+                    help='label: swap control and affected per site at random, shuffle: shuffle the methylation values of the sites within each chromosome (default: label)')
+    group.add_argument('--seed', type=int, default=0, help='Seed of the first permutation, the following permutations use the next integers (default: 0)')
+
+    group = parser.add_argument_group('parameter sweep', 'Call the DMRs for all combinations of the given comma separated values (none disables --allow-failed or --max-cpg-distance). '
+        'The input is parsed only once, each combination is written to <PREFIX>_delta<D>_lastn<N>_failed<F>_distance<G>.bed and --outfile gets a summary table.')
+    group.add_argument('--sweep', metavar='PREFIX', default=None, help='Enable the sweep mode and write the results with that path prefix.')
+    group.add_argument('--sweep-min-delta-methylation', dest='sweep_min_delta_methylation', metavar='LIST', type=parameter_list, help='e.g. 20,25,30')
+    group.add_argument('--sweep-check-last-n', dest='sweep_check_last_n', metavar='LIST', type=parameter_list, help='e.g. 3,4,5')
+    group.add_argument('--sweep-allow-failed', dest='sweep_allow_failed', metavar='LIST', type=optional_parameter_list, help='e.g. none,0,1')
+    group.add_argument('--sweep-max-cpg-distance', dest='sweep_max_cpg_distance', metavar='LIST', type=optional_parameter_list, help='e.g. none,500,1000')
+
     options = parser.parse_args()
-    dmr(options)
+    try:
+        dmr(options)
+    except WorkerExit as error:
+        sys.exit( error.args[0] )
 
 if __name__ == '__main__':
     main()
@@ -3,10 +3,13 @@
 
 import os, sys
 import argparse
+import tempfile
+import shutil
+import multiprocessing
 import numpy as np
-from itertools import izip
-from scipy.stats.mstats import mquantiles
+from itertools import izip, compress
 from scipy import stats
+from methtools.sites import aligned_blocks, joined_blocks, read_blocks, read_chrom_order, read_range, split_ranges, WorkerExit, exit_in_parent
 try:
     import fisher as fisher_exact
 except:
@@ -15,60 +18,356 @@ except:
 
 """
     That file needs intersected inputfiles, so that each site is present in both files, affected and control.
+    With --join the inputfiles do not need to be intersected, but they need to be sorted by chromosome and start
+    position. Only sites that are present in both files are considered.
 """
 
-def filtering(control_file, affected_file, filtered_control_file, filtered_affected_file, max_pvalue = None, min_cov = None, max_cov = None, min_delta_methylation = None, filter_quantil = None):
+# pvalue histogram for --fdr, see pvalue_bins()
+PVALUE_BIN_SHIFT = 12
+PVALUE_BINS = int( np.array(1.0, dtype=np.float32).view(np.uint32) >> PVALUE_BIN_SHIFT ) + 1
+
+def coverage_histogram(path, cache = False):
+    """
+        Arguments:
+            path -- path to a BED6 methylation call file
+            cache -- reuse or create a histogram sidecar file (path + '.covhist')
+
+        Return:
+            numpy array, the i-th element is the number of sites with coverage i
+
+        Coverage values are integers, so a histogram over all coverages is an
+        exact and tiny representation of the coverage distribution. Only the
+        coverage column is parsed, block by block, so the memory consumption
+        does not depend on the number of sites.
+    """
+    cache_path = '%s.covhist' % path
+    if cache and os.path.exists( cache_path ) and os.path.getmtime( cache_path ) >= os.path.getmtime( path ):
+        with open(cache_path, 'rb') as handle:
+            return np.load( handle )
+
+    histogram = np.zeros(0, dtype=np.int64)
+    with open(path) as handle:
+        for block in read_blocks( handle ):
+            counts = np.bincount( np.rint(block.cov).astype(np.int64) )
+            if len(counts) > len(histogram):
+                counts[ :len(histogram) ] += histogram
+                histogram = counts
+            else:
+                histogram[ :len(counts) ] += counts
+
+    if cache:
+        try:
+            with open(cache_path, 'wb') as handle:
+                np.save( handle, histogram )
+        except (IOError, OSError):
+            sys.stderr.write('Could not write the coverage histogram cache %s.\n' % cache_path)
+    return histogram
+
+
+def histogram_quantile(histogram, prob, alphap = 0.4, betap = 0.4):
+    """
+        Arguments:
+            histogram -- coverage histogram, as returned by coverage_histogram()
+            prob -- quantile to compute, example for the 99.9 quantil: 0.999
+            alphap, betap -- plotting positions, see scipy.stats.mstats.mquantiles
+
+        Return:
+            the quantile of the coverages described by the histogram
+
+        Gives the same result as mquantiles() over all coverage values, the
+        two order statistics needed for the interpolation are looked up in
+        the cumulative histogram instead of a sorted array.
+
+        >>> histogram_quantile(np.bincount([3, 1, 4, 1, 5, 9, 2, 6]), 0.5)
+        3.5
+    """
+    cumulative = np.cumsum( histogram )
+    n = cumulative[-1] if len(cumulative) else 0
+    if n == 0:
+        return np.nan
+    if n == 1:
+        return float( np.searchsorted(cumulative, 1) )
+    aleph = n * prob + alphap + prob * (1.0 - alphap - betap)
+    k = int( np.floor( np.clip(aleph, 1, n - 1) ) )
+    gamma = np.clip(aleph - k, 0.0, 1.0)
+    # the (k-1)-th and k-th element of the sorted coverages
+    lower = np.searchsorted(cumulative, k)
+    upper = np.searchsorted(cumulative, k + 1)
+    return (1.0 - gamma) * lower + gamma * upper
+
+
+def site_mask(control, affected, min_cov = None, max_cov = None, min_delta_methylation = None, control_quantil = None, affected_quantil = None):
+    """
+        Arguments:
+            control, affected -- aligned SiteBlock objects
+            control_quantil, affected_quantil -- maximal coverage, as computed from --quantil
+
+        Return:
+            boolean array, True for all sites that pass the coverage and methylation filters
+    """
+    mask = np.ones( len(control), dtype=bool )
+    if min_cov != None:
+        mask &= (control.cov >= min_cov) & (affected.cov >= min_cov)
+    if max_cov != None:
+        mask &= (control.cov <= max_cov) & (affected.cov <= max_cov)
+    if min_delta_methylation != None:
+        mask &= np.abs( affected.meth - control.meth ) >= min_delta_methylation
+    if control_quantil != None:
+        mask &= (control.cov <= control_quantil) & (affected.cov <= affected_quantil)
+    return mask
+
+
+def fisher_pvalues(c_cov, c_meth, a_cov, a_meth):
+    """
+        Arguments:
+            c_cov, c_meth, a_cov, a_meth -- arrays with coverage and methylation of the control and affected sites
+
+        Return:
+            array with the two-sided fisher exact test pvalue of each site
+    """
+    control_methylated = c_cov * c_meth / 100
+    control_unmethylated = c_cov - control_methylated
+    affected_methylated = a_cov * a_meth / 100
+    affected_unmethylated = a_cov - affected_methylated
+    try:
+        #Try to use the much faster fisher module from http://pypi.python.org/pypi/fisher/
+        left, right, pvalues = fisher_exact.pvalue_npy( control_methylated.astype(np.uint), control_unmethylated.astype(np.uint), affected_methylated.astype(np.uint), affected_unmethylated.astype(np.uint) )
+    except:
+        # scipy truncates the counts to integers, so equal tables are only tested once
+        tables = np.column_stack( (control_methylated, control_unmethylated, affected_methylated, affected_unmethylated) ).astype(np.int64)
+        cache = dict()
+        pvalues = np.empty( len(c_cov) )
+        for i, table in enumerate( map(tuple, tables.tolist()) ):
+            if table not in cache:
+                oddsratio, cache[table] = stats.fisher_exact([table[:2], table[2:]], alternative='two-sided')
+            pvalues[i] = cache[table]
+    return pvalues
+
+
+def pvalue_bins(pvalues):
+    """
+        Arguments:
+            pvalues -- array of pvalues
+
+        Return:
+            array with the histogram bin of each pvalue
+
+        The bins are the upper 20 bits of the float32 representation, for
+        pvalues between 0 and 1 that are 2**18 bins with a relative width of
+        2**-11. Larger pvalues have larger bits, so the bins are sorted.
+    """
+    pvalues = np.clip( np.asarray(pvalues, dtype=np.float32), 0.0, 1.0 )
+    return pvalues.view( np.uint32 ) >> PVALUE_BIN_SHIFT
+
+
+def float32_pvalues(pvalues):
+    """
+        Returns the pvalues as float32, rounded up and not to the nearest
+        float32. No pvalue falls into a bin below its value, so the qvalues
+        of bh_qvalues() stay conservative.
+    """
+    rounded = np.asarray( pvalues, dtype=np.float32 )
+    below = rounded < pvalues
+    rounded[below] = np.nextafter( rounded[below], np.float32(np.inf) )
+    return rounded
+
+
+def bh_qvalues(histogram):
+    """
+        Arguments:
+            histogram -- histogram of all pvalues, binned with pvalue_bins()
+
+        Return:
+            array with the Benjamini-Hochberg qvalue of each bin
+
+        The qvalue of a bin is min( p * m / rank ) over that bin and all
+        following bins, where p is the largest pvalue of a bin and rank the
+        number of pvalues in that bin and all bins before. Using the largest
+        pvalue of each bin makes the qvalues slightly conservative.
+    """
+    m = histogram.sum()
+    ranks = np.cumsum( histogram ).astype(float)
+    upper_edges = ((np.arange(1, len(histogram) + 1, dtype=np.uint32) << PVALUE_BIN_SHIFT) - 1).view( np.float32 ).astype(float)
+    with np.errstate(divide='ignore'):
+        qvalues = np.where( ranks > 0, upper_edges * m / ranks, np.inf )
+    qvalues = np.minimum.accumulate( qvalues[::-1] )[::-1]
+    return np.minimum( qvalues, 1.0 )
+
+
+def site_blocks(control_file, affected_file, join = False, chrom_order = None, control_range = None, affected_range = None):
+    """
+        Returns an iterator over (control, affected) SiteBlock pairs, optionally
+        restricted to byte ranges as returned by split_ranges().
+    """
+    control = read_range( control_file, control_range )
+    affected = read_range( affected_file, affected_range )
+    if join:
+        return joined_blocks( [control, affected], chrom_order )
+    else:
+        return aligned_blocks( control, affected )
+
+
+def pvalue_pass(blocks, spill, thresholds):
+    """
+        First pass of --fdr: calculate the pvalues of all tested sites and
+        append them to the float32 spill file. Returns the pvalue histogram.
+    """
+    histogram = np.zeros( PVALUE_BINS, dtype=np.int64 )
+    for control, affected in blocks:
+        candidates = np.flatnonzero( site_mask(control, affected, *thresholds) )
+        pvalues = float32_pvalues( fisher_pvalues( control.cov[candidates], control.meth[candidates], affected.cov[candidates], affected.meth[candidates] ) )
+        pvalues.tofile( spill )
+        histogram += np.bincount( pvalue_bins(pvalues), minlength = PVALUE_BINS )
+    return histogram
+
+
+def filter_pass(blocks, filtered_control_file, filtered_affected_file, thresholds, max_pvalue = None, fdr = None, qvalues = None, spill = None, qvalue_file = None):
+    """
+        Writes all sites that pass the filters. With --fdr the pvalues are read
+        from the spill file written by pvalue_pass().
+        Returns the number of sites and the number of written sites.
+    """
+    non_filtered_sites = 0
+    site_counter = 0
+    for control, affected in blocks:
+        site_counter += len(control)
+        mask = site_mask(control, affected, *thresholds)
+
+        if (max_pvalue != None or fdr != None) and mask.any():
+            candidates = np.flatnonzero( mask )
+            if fdr != None:
+                pvalues = np.fromfile( spill, dtype=np.float32, count=len(candidates) )
+                site_qvalues = qvalues[ pvalue_bins(pvalues) ]
+                mask[ candidates[ site_qvalues > fdr ] ] = False
+            else:
+                pvalues = fisher_pvalues( control.cov[candidates], control.meth[candidates], affected.cov[candidates], affected.meth[candidates] )
+            if max_pvalue != None:
+                mask[ candidates[ pvalues > max_pvalue ] ] = False
+
+            if qvalue_file and fdr != None:
+                passed = mask[ candidates ]
+                for index, pvalue, qvalue in izip( candidates[passed], pvalues[passed], site_qvalues[passed] ):
+                    qvalue_file.write( '%s\t%s\t%s\t%e\t%e\t%s\n' % (control.chrom[index], control.start[index], control.end[index], pvalue, qvalue, control.strand[index]) )
+
+        non_filtered_sites += np.count_nonzero( mask )
+        filtered_control_file.write( ''.join( compress(control.lines, mask) ) )
+        filtered_affected_file.write( ''.join( compress(affected.lines, mask) ) )
+    return site_counter, non_filtered_sites
+
+
+@exit_in_parent
+def run_pvalue_pass( args ):
+    """
+        Multiprocessing helper function.
+        Runs the first --fdr pass for one chunk and returns the spill file and the pvalue histogram.
+    """
+    temp_dir, control_file, affected_file, control_range, affected_range, join, chrom_order, thresholds = args
+    with tempfile.NamedTemporaryFile(dir=temp_dir, prefix='spill', delete=False) as spill:
+        histogram = pvalue_pass( site_blocks(control_file, affected_file, join, chrom_order, control_range, affected_range), spill, thresholds )
+    return spill.name, histogram
+
+
+@exit_in_parent
+def run_filter_pass( args ):
+    """
+        Multiprocessing helper function.
+        Filters one chunk into temporary files and returns their names together with the site counts.
+    """
+    temp_dir, control_file, affected_file, control_range, affected_range, join, chrom_order, thresholds, max_pvalue, fdr, qvalues, spill_path, with_qvalues = args
+    control_out = tempfile.NamedTemporaryFile(dir=temp_dir, prefix='control', delete=False)
+    affected_out = tempfile.NamedTemporaryFile(dir=temp_dir, prefix='affected', delete=False)
+    qvalue_out = None
+    if with_qvalues:
+        qvalue_out = tempfile.NamedTemporaryFile(dir=temp_dir, prefix='qvalues', delete=False)
+    spill = None
+    if spill_path:
+        spill = open( spill_path, 'rb' )
+
+    counts = filter_pass( site_blocks(control_file, affected_file, join, chrom_order, control_range, affected_range), control_out, affected_out, thresholds, max_pvalue, fdr, qvalues, spill, qvalue_out )
+
+    names = [control_out.name, affected_out.name, None]
+    control_out.close()
+    affected_out.close()
+    if qvalue_out:
+        names[2] = qvalue_out.name
+        qvalue_out.close()
+    if spill:
+        spill.close()
+    return counts, names
+
+
+def filtering(control_file, affected_file, filtered_control_file, filtered_affected_file, max_pvalue = None, min_cov = None, max_cov = None, min_delta_methylation = None, filter_quantil = None, quantil_cache = False, join = False, chrom_order = None, fdr = None, qvalue_file = None, processors = 1):
 
     control_quantil = None
     affected_quantil = None
     if filter_quantil:
-        control_quantil = mquantiles( np.loadtxt(control_file, delimiter='\t', usecols=(3,)), prob = [filter_quantil])[0]
-        affected_quantil = mquantiles( np.loadtxt(affected_file, delimiter='\t', usecols=(3,)), prob = [filter_quantil])[0]
+        control_quantil = histogram_quantile( coverage_histogram(control_file, quantil_cache), filter_quantil )
+        affected_quantil = histogram_quantile( coverage_histogram(affected_file, quantil_cache), filter_quantil )
+    thresholds = (min_cov, max_cov, min_delta_methylation, control_quantil, affected_quantil)
 
-    non_filtered_sites = 0
-    for site_counter, (control_line, affected_line) in enumerate( izip(open(control_file), open(affected_file)) ):
-        c_chrom, c_start, c_end, c_cov, c_meth, c_strand = control_line.strip().split('\t')
-        a_chrom, a_start, a_end, a_cov, a_meth, a_strand = affected_line.strip().split('\t')
-        try:
-            assert( c_chrom == a_chrom )
-            assert( c_start == a_start )
-            assert( c_end == a_end )
-            assert( c_strand == a_strand )
-        except AssertionError:
-            sys.exit('That file needs intersected inputfiles, so that each site is present in both files, affected and control.\n %s : %s \n %s : %s \n %s : %s \n %s : %s \n' % (c_chrom, a_chrom, c_start, a_start, c_end, a_end, c_strand, a_strand))
-
-        c_cov, c_meth, a_cov, a_meth = map(float, [c_cov, c_meth, a_cov, a_meth])
-        if min_cov != None and (a_cov < min_cov or c_cov < min_cov):
-            continue
-        if max_cov != None and (a_cov > max_cov or c_cov > max_cov):
-            continue
-        if min_delta_methylation != None and abs(a_meth - c_meth) < min_delta_methylation:
-            continue
-        if filter_quantil and (c_cov > control_quantil or a_cov > affected_quantil):
-            continue
-
-        if max_pvalue != None:
-            control_methylated = c_cov * c_meth / 100
-            control_unmethylated = c_cov - control_methylated
-            affected_methylated = a_cov * a_meth / 100
-            affected_unmethylated = a_cov - affected_methylated
-            try:
-                #Try to use the much faster fisher module from http://pypi.python.org/pypi/fisher/
-                p = fisher_exact.pvalue(control_methylated, control_unmethylated, affected_methylated, affected_unmethylated)
-                pvalue = p.two_tail
-            except:
-                oddsratio, pvalue = stats.fisher_exact([(control_methylated, control_unmethylated), (affected_methylated, affected_unmethylated)], alternative='two-sided')
-
-            if pvalue > max_pvalue:
-                continue
-
-        non_filtered_sites += 1
-        filtered_control_file.write(control_line)
-        filtered_affected_file.write(affected_line)
-
-    sys.stdout.write( "%s from %s filtered.\n" % (site_counter+1 - non_filtered_sites, site_counter + 1) )
+    """
+        With --fdr the first pass calculates the pvalues of all tested sites
+        and stores them in a float32 spill file, the qvalues are derived from
+        a fixed size pvalue histogram. In the second pass the pvalues are read
+        back in the same order.
+    """
+    if processors > 1:
+        site_counter, non_filtered_sites = parallel_filtering( control_file, affected_file, filtered_control_file, filtered_affected_file, thresholds, max_pvalue, join, chrom_order, fdr, qvalue_file, processors )
+    else:
+        spill = None
+        qvalues = None
+        if fdr != None:
+            spill = tempfile.TemporaryFile()
+            histogram = pvalue_pass( site_blocks(control_file, affected_file, join, chrom_order), spill, thresholds )
+            qvalues = bh_qvalues( histogram )
+            spill.flush()
+            spill.seek(0)
+
+        site_counter, non_filtered_sites = filter_pass( site_blocks(control_file, affected_file, join, chrom_order), filtered_control_file, filtered_affected_file, thresholds, max_pvalue, fdr, qvalues, spill, qvalue_file )
+        if spill:
+            spill.close()
+
+    sys.stdout.write( "%s from %s filtered.\n" % (site_counter - non_filtered_sites, site_counter) )
     filtered_affected_file.close()
     filtered_control_file.close()
+    if qvalue_file:
+        qvalue_file.close()
+
+
+def parallel_filtering(control_file, affected_file, filtered_control_file, filtered_affected_file, thresholds, max_pvalue, join, chrom_order, fdr, qvalue_file, processors):
+    """
+        Splits both input files into chunks at line boundaries, filters all
+        chunks in a process pool and concatenates the results in order.
+        Returns the number of sites and the number of written sites.
+    """
+    temp_dir = tempfile.mkdtemp()
+    ranges = split_ranges( control_file, affected_file, processors * 4, join, chrom_order )
+    pool = multiprocessing.Pool( processors )
+    try:
+        spill_paths = [None] * len(ranges)
+        qvalues = None
+        if fdr != None:
+            results = pool.map( run_pvalue_pass, [(temp_dir, control_file, affected_file, control_range, affected_range, join, chrom_order, thresholds) for control_range, affected_range in ranges] )
+            spill_paths = [spill_path for spill_path, histogram in results]
+            qvalues = bh_qvalues( sum( histogram for spill_path, histogram in results ) )
+
+        jobs = [(temp_dir, control_file, affected_file, control_range, affected_range, join, chrom_order, thresholds, max_pvalue, fdr, qvalues, spill_path, bool(qvalue_file))
+            for (control_range, affected_range), spill_path in izip(ranges, spill_paths)]
+        site_counter = 0
+        non_filtered_sites = 0
+        for (sites, written), names in pool.imap( run_filter_pass, jobs ):
+            site_counter += sites
+            non_filtered_sites += written
+            for name, handle in izip( names, [filtered_control_file, filtered_affected_file, qvalue_file] ):
+                if name:
+                    shutil.copyfileobj( open(name, 'rb'), handle )
+    finally:
+        # the pool is terminated as well if a worker exits
+        pool.terminate()
+        pool.join()
+        # cleaning temporary working directory
+        shutil.rmtree( temp_dir )
+    return site_counter, non_filtered_sites
 
 
 def main():
@@ -88,6 +387,12 @@ def main():
     parser.add_argument("--pvalue", default=None, type=float,
                     help="maximal pvalue to classify a site as differential methylated")
 
+    parser.add_argument("--fdr", default=None, type=float,
+                    help="maximal Benjamini-Hochberg qvalue (false discovery rate) to classify a site as differential methylated")
+
+    parser.add_argument("--oqvalues", dest="qvalue_file", type=argparse.FileType('w'), default=None,
+                    help="Write the pvalue and qvalue of all remaining sites to that file, only with --fdr (chrom, start, end, pvalue, qvalue, strand).")
+
     parser.add_argument("--min-coverage", dest="min_cov", default=None, type=int,
                     help="minimal allowed coverage")
 
@@ -100,10 +405,30 @@ def main():
     parser.add_argument("--quantil", dest="filter_quantil", default=None, type=float,
                     help="coverage quantil filter, example for the 99.9 quantil: 0.999")
 
+    parser.add_argument("--quantil-cache", dest="quantil_cache", action='store_true', default=False,
+                    help="Store the coverage histogram of each input file besides the file (<input>.covhist) and reuse it in later runs.")
+
+    parser.add_argument('-p', '--processors', type=int, default=1,
+                    help="Number of processes, the input files are split into chunks that are filtered in parallel (default:1)")
+
+    parser.add_argument("--join", action='store_true', default=False,
+                    help="The input files are not intersected. Join them on the fly, both files need to be sorted by chromosome and start position.")
+
+    parser.add_argument("--chrom-order", dest="chrom_order", default=None,
+                    help="File with the chromosome sort order of the input files in the first column, e.g. a genome file (default: lexicographic order)")
+
     options = parser.parse_args()
-    if [options.pvalue, options.min_cov, options.max_cov, options.filter_quantil].count(None) == 4:
-        sys.exit('You need to specify at least one filter parameter: --pvalue, --min-coverage, --quantil or --max-coverage')
-    filtering(options.control, options.affected, options.ocontrol, options.oaffected, options.pvalue, options.min_cov, options.max_cov, options.min_delta_methylation, options.filter_quantil)
+    if [options.pvalue, options.fdr, options.min_cov, options.max_cov, options.filter_quantil].count(None) == 5:
+        sys.exit('You need to specify at least one filter parameter: --pvalue, --fdr, --min-coverage, --quantil or --max-coverage')
+    if options.qvalue_file and options.fdr == None:
+        sys.exit('--oqvalues needs --fdr.')
+    chrom_order = None
+    if options.chrom_order:
+        chrom_order = read_chrom_order( options.chrom_order )
+    try:
+        filtering(options.control, options.affected, options.ocontrol, options.oaffected, options.pvalue, options.min_cov, options.max_cov, options.min_delta_methylation, options.filter_quantil, options.quantil_cache, options.join, chrom_order, options.fdr, options.qvalue_file, options.processors)
+    except WorkerExit as error:
+        sys.exit( error.args[0] )
 
 
 if __name__ == '__main__':
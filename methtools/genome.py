@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os, sys
+import argparse
+import tempfile
+import StringIO
+from itertools import chain
+from collections import OrderedDict
+from contextlib import closing
+
+__doc__ = """
+    Local cache of genome files, so that --organism-tag can be resolved
+    without network access.
+
+    The genome file of an organism tag, e.g. mm10, is searched in that order:
+        1. the cache directory: --genome-cache, the environment variable
+           METHTOOLS_GENOME_CACHE or ~/.methtools/genomes
+        2. the genome files bundled with methtools (hg18, hg19, hg38, mm9, mm10, dm3)
+        3. the UCSC Genome Browser's MySQL database, the result is stored in the cache
+
+    Each cached genome is a file <tag>.genome in the cache directory.
+
+    Other sources of the chromosome sizes are the header of a BAM file and
+    #genome header lines in a methylation call file (see calling --genome-header):
+
+    #genome	chr1	249250621
+    #genome	chr2	243199373
+
+    Example calls:
+        methtools genome fetch rn5 danRer7
+        methtools genome import myAssembly my_assembly.genome
+        methtools genome list
+"""
+
+BUNDLED_DIRECTORY = os.path.join( os.path.dirname( os.path.abspath(__file__) ), 'genomes' )
+CACHE_ENVIRONMENT = 'METHTOOLS_GENOME_CACHE'
+# header lines of methylation call files with the chromosome sizes: #genome<TAB><chrom name><TAB><chrom size>
+GENOME_HEADER = '#genome'
+
+
+def read_genome_file(genome_path):
+    """
+        Arguments:
+            genome_path -- file like object
+
+        Return:
+            dictionary with chromosome name <-> size mapping, in file order
+
+        Reads a genome file into a dictionary. 
+        The genome file in needed to know the borders of each chromosom to 
+        adjust the windows properly.
+        Additional columns are ignored, so a FASTA index (*.fai) can be used
+        as genome file as well.
+        closing() is needed, because if the user specified an organism_tag the
+        genome_path will be a StringIO Stream, which has no close definition.
+    """
+    genome_dict = OrderedDict()
+    with closing(genome_path) as handle:
+        for line in handle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                parts = line.split('\t')
+                if len(parts) < 2:
+                    continue
+                chrom, size = parts[:2]
+                try:
+                    size = int(size)
+                except:
+                    continue
+                genome_dict[chrom] = size
+    return genome_dict
+
+
+def genome_from_bam(bam_path):
+    """
+        Returns a dictionary with chromosome name <-> size mapping, taken from
+        the header of a SAM/BAM file. Index files like *.bai or *.tbi do not
+        store the chromosome sizes.
+    """
+    import pysam
+    samfile = pysam.Samfile( bam_path, 'rb' )
+    genome_dict = OrderedDict( zip(samfile.references, samfile.lengths) )
+    samfile.close()
+    return genome_dict
+
+
+def genome_header(references, lengths):
+    """
+        Returns the header lines that embed the chromosome sizes into a
+        methylation call file.
+
+        >>> genome_header(['chr1', 'chr2'], [249250621, 243199373])
+        '#genome\\tchr1\\t249250621\\n#genome\\tchr2\\t243199373\\n'
+    """
+    return ''.join( '%s\t%s\t%s\n' % (GENOME_HEADER, chrom, size) for chrom, size in zip(references, lengths) )
+
+
+def read_genome_header(handle):
+    """
+        Arguments:
+            handle -- iterable over the lines of a methylation call file
+
+        Return:
+            (genome, lines) tuple, genome is a dictionary with the chromosome
+            sizes of the #genome header lines and lines an iterator over all
+            lines of the file, including the first line after the header
+    """
+    genome_dict = OrderedDict()
+    lines = iter(handle)
+    for line in lines:
+        if line.startswith( GENOME_HEADER + '\t' ):
+            chrom, size = line.rstrip('\r\n').split('\t')[1:3]
+            genome_dict[chrom] = int(size)
+        elif line.startswith('#') or not line.strip():
+            continue
+        else:
+            return genome_dict, chain( [line], lines )
+    return genome_dict, iter([])
+
+
+def cache_directory(directory = None):
+    """
+        Returns the genome cache directory, directory if it is given.
+    """
+    return directory or os.environ.get( CACHE_ENVIRONMENT ) or os.path.join( os.path.expanduser('~'), '.methtools', 'genomes' )
+
+
+def genome_path(tag, directory = None):
+    """
+        Returns the path of the cached or bundled genome file of tag, or None.
+    """
+    for path in [os.path.join( cache_directory(directory), '%s.genome' % tag ), os.path.join( BUNDLED_DIRECTORY, '%s.genome' % tag )]:
+        if os.path.exists( path ):
+            return path
+    return None
+
+
+def fetch_genome(tag):
+    """
+        Returns the genome file of tag, downloaded from the UCSC Genome
+        Browser's MySQL database.
+    """
+    import sqlalchemy
+    engine = sqlalchemy.create_engine('mysql://genome@genome-mysql.cse.ucsc.edu')
+    output = engine.execute("select chrom, size from %s.chromInfo" % tag)
+    return ''.join(['%s\t%s\n' % (r[0],r[1]) for r in output])
+
+
+def store_genome(tag, content, directory = None):
+    """
+        Arguments:
+            tag -- organism tag
+            content -- content of a genome file
+            directory -- cache directory
+
+        Return:
+            path of the cached genome file
+
+        The file is written to a temporary file and renamed, so parallel jobs
+        never read a partially written genome file.
+    """
+    genome = read_genome_file( StringIO.StringIO(content) )
+    if not genome:
+        sys.exit('The genome file of %s contains no chromosome sizes.' % tag)
+    directory = cache_directory( directory )
+    if not os.path.isdir( directory ):
+        os.makedirs( directory )
+    handle, temp_path = tempfile.mkstemp( dir = directory, suffix = '.tmp' )
+    with os.fdopen( handle, 'w' ) as temp_file:
+        temp_file.write( content )
+    path = os.path.join( directory, '%s.genome' % tag )
+    os.rename( temp_path, path )
+    return path
+
+
+def load_genome(tag, directory = None):
+    """
+        Arguments:
+            tag -- organism tag, e.g. mm10
+            directory -- cache directory
+
+        Return:
+            dictionary with chromosome name <-> size mapping
+
+        The network is only used if the genome is neither cached nor bundled,
+        the downloaded genome file is stored in the cache.
+    """
+    tag = tag.strip()
+    path = genome_path( tag, directory )
+    if path is None:
+        try:
+            content = fetch_genome( tag )
+        except:
+            sys.exit('Fetching of the genome file failed! You need a working internet connection and mysql client installed.\nPlease download manually and specify it with --genome_file or add it to the cache with "methtools genome import %s <genome file>".' % tag)
+        try:
+            path = store_genome( tag, content, directory )
+        except (IOError, OSError):
+            sys.stderr.write('The genome file of %s could not be stored in the cache %s.\n' % (tag, cache_directory(directory)))
+            return read_genome_file( StringIO.StringIO(content) )
+    return read_genome_file( open(path) )
+
+
+def fetch(options):
+    for tag in options.tags:
+        path = genome_path( tag, options.cache )
+        if path and not options.force:
+            print '%s: %s' % (tag, path)
+            continue
+        try:
+            content = fetch_genome( tag )
+        except:
+            sys.exit('Fetching of the genome file of %s failed! You need a working internet connection and mysql client installed.' % tag)
+        print '%s: %s' % (tag, store_genome( tag, content, options.cache ))
+
+
+def import_genome(options):
+    with closing(options.genome_file) as handle:
+        content = handle.read()
+    print '%s: %s' % (options.tag, store_genome( options.tag, content, options.cache ))
+
+
+def list_genomes(options):
+    directories = [('cached', cache_directory(options.cache)), ('bundled', BUNDLED_DIRECTORY)]
+    for label, directory in directories:
+        if not os.path.isdir( directory ):
+            continue
+        for filename in sorted( os.listdir(directory) ):
+            if filename.endswith('.genome'):
+                print '%s\t%s\t%s' % (filename[:-len('.genome')], label, os.path.join(directory, filename))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Manage the local cache of genome files.',
+        epilog = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cache', default=None,
+        help='Cache directory (default: $%s or ~/.methtools/genomes)' % CACHE_ENVIRONMENT)
+    subparsers = parser.add_subparsers()
+
+    fetch_parser = subparsers.add_parser('fetch', help='Download genome files from the UCSC Genome Browser into the cache.')
+    fetch_parser.add_argument('tags', nargs='+', metavar='TAG', help='Organism tags, e.g. mm10 or hg18')
+    fetch_parser.add_argument('--force', action='store_true', default=False, help='Download the genome even if it is cached or bundled.')
+    fetch_parser.set_defaults(func=fetch)
+
+    import_parser = subparsers.add_parser('import', help='Add a genome file to the cache.')
+    import_parser.add_argument('tag', metavar='TAG', help='Organism tag that is used with --organism-tag')
+    import_parser.add_argument('genome_file', type=argparse.FileType('r'), help='Genome file: <chrom name><TAB><chrom size>')
+    import_parser.set_defaults(func=import_genome)
+
+    list_parser = subparsers.add_parser('list', help='List all cached and bundled genomes.')
+    list_parser.set_defaults(func=list_genomes)
+
+    options = parser.parse_args()
+    options.func(options)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os, sys
+import numpy as np
+
+__doc__ = """
+    Index of genomic features (genes, promoters, CpG islands, ...) from a BED
+    file, to annotate regions with the overlapping and the nearest feature.
+
+    The features of each chromosome are stored as arrays sorted by start
+    position, all lookups are binary searches on these arrays.
+
+    Example feature bed file, the name column is optional:
+
+    chr1	11873	14409	DDX11L1
+    chr1	28735	29810	CpG:_116
+"""
+
+
+class IntervalIndex():
+    """
+        Features of one BED file, stored per chromosome as arrays sorted by
+        start position.
+    """
+    def __init__(self, path, name = None):
+        self.name = name or os.path.splitext( os.path.basename(path) )[0]
+        features = dict()
+        for line in open(path):
+            if not line.strip() or line.startswith( ('#', 'track', 'browser') ):
+                continue
+            parts = line.rstrip('\r\n').split('\t')
+            if len(parts) < 3:
+                sys.exit('The feature file %s needs at least 3 columns (chrom, start, end).\n%s\n' % (path, line.strip()))
+            chrom, start, end = parts[0], int(parts[1]), int(parts[2])
+            if len(parts) > 3 and parts[3]:
+                feature_name = parts[3]
+            else:
+                feature_name = '%s:%s-%s' % (chrom, start, end)
+            features.setdefault( chrom, list() ).append( (start, end, feature_name) )
+
+        self.starts = dict()
+        self.ends = dict()
+        self.names = dict()
+        self.max_ends = dict()
+        self.max_end_index = dict()
+        for chrom, chrom_features in features.iteritems():
+            chrom_features.sort()
+            starts, ends, names = zip( *chrom_features )
+            self.starts[chrom] = np.array( starts, dtype = np.int64 )
+            self.ends[chrom] = np.array( ends, dtype = np.int64 )
+            self.names[chrom] = names
+            # the running maximum of the end positions is sorted as well, it
+            # bounds the features that can reach a position from the left
+            self.max_ends[chrom] = np.maximum.accumulate( self.ends[chrom] )
+            index = np.arange( len(ends) )
+            index[ self.ends[chrom] < self.max_ends[chrom] ] = 0
+            self.max_end_index[chrom] = np.maximum.accumulate( index )
+
+    def __len__(self):
+        return sum( len(starts) for starts in self.starts.itervalues() )
+
+    def __repr__(self):
+        return 'IntervalIndex: %s with %s features' % (self.name, len(self))
+
+    def overlapping(self, chrom, start, end):
+        """
+            Returns the names of all features overlapping the half-open
+            interval start - end, ordered by start position.
+        """
+        if chrom not in self.starts:
+            return []
+        # features starting before end, that end after start
+        high = np.searchsorted( self.starts[chrom], end, side = 'left' )
+        low = np.searchsorted( self.max_ends[chrom], start, side = 'right' )
+        if low >= high:
+            return []
+        ends = self.ends[chrom]
+        names = self.names[chrom]
+        return [names[i] for i in xrange( low, high ) if ends[i] > start]
+
+    def nearest(self, chrom, start, end):
+        """
+            Return:
+                (name, distance) of the nearest feature of the interval
+                start - end, the distance of an overlapping feature is 0.
+                (None, None) if the chromosome has no features.
+        """
+        if chrom not in self.starts:
+            return None, None
+        overlapping = self.overlapping( chrom, start, end )
+        if overlapping:
+            return overlapping[0], 0
+
+        starts = self.starts[chrom]
+        nearest = (None, None)
+        # the feature with the highest end position among all features left of the interval
+        left = np.searchsorted( starts, start, side = 'left' ) - 1
+        if left >= 0:
+            i = self.max_end_index[chrom][left]
+            nearest = (self.names[chrom][i], start - self.ends[chrom][i])
+        # the first feature right of the interval
+        right = np.searchsorted( starts, end, side = 'left' )
+        if right < len(starts):
+            distance = starts[right] - end
+            if nearest[1] is None or distance < nearest[1]:
+                nearest = (self.names[chrom][right], distance)
+        return nearest[0], int(nearest[1])
+
+    def annotate(self, chrom, start, end):
+        """
+            Returns the tab separated annotation columns of an interval:
+            overlapping features (comma separated or '.'), nearest feature and
+            its distance ('.' if the chromosome has no features).
+        """
+        overlapping = self.overlapping( chrom, start, end )
+        name, distance = self.nearest( chrom, start, end )
+        if name is None:
+            name, distance = '.', '.'
+        return '%s\t%s\t%s' % (','.join( overlapping ) or '.', name, distance)
+
+
+def annotation_argument(text):
+    """
+        argparse type for NAME=BED arguments, without NAME the file name
+        without extension is used.
+
+        >>> annotation_argument('promoters=/data/promoters.bed')
+        ('promoters', '/data/promoters.bed')
+        >>> annotation_argument('/data/cpg_islands.bed')
+        ('cpg_islands', '/data/cpg_islands.bed')
+    """
+    if '=' in text:
+        name, path = text.split('=', 1)
+    else:
+        name, path = None, text
+    return name or os.path.splitext( os.path.basename(path) )[0], path
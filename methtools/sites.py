@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os, sys
+import numpy as np
+from functools import wraps
+from itertools import islice, izip, chain
+
+__doc__ = """
+    Helper functions to read BED6 methylation call files in blocks of sites.
+
+    Each block keeps the original lines, so that filtered sites can be
+    written out unchanged, and holds the numeric columns as numpy arrays, so
+    that all site predicates can be evaluated at once for the whole block.
+    A block is split into its columns with one str.split() call and only
+    the numeric columns that are used are converted.
+
+    Example methylation call bed file:
+
+    chr7	3295867	3295868	14	85.71	-
+    chr7	4469970	4469971	30	6.67	+
+
+    Files that are not intersected can be joined on the fly with
+    joined_lines(), in that case all files need to be sorted by chromosome
+    and start position, for example with:
+        sort -k1,1 -k2,2n control.bed > control_sorted.bed
+
+    If the chromosomes are sorted in a different order, e.g. the order of a
+    genome file, that order can be given as chrom_order.
+"""
+
+BLOCK_SIZE = 100000
+
+COLUMNS = ['chrom', 'start', 'end', 'cov', 'meth', 'strand']
+# numpy dtype of the numeric columns, the others are kept as lists
+COLUMN_TYPES = {'chrom': None, 'start': np.int64, 'end': np.int64, 'cov': float, 'meth': float, 'strand': None}
+
+
+class WorkerExit(Exception):
+    """
+        sys.exit() of a multiprocessing pool worker. The pool passes only
+        Exceptions on to the parent, a SystemExit kills the worker and the
+        parent waits forever for its result.
+    """
+
+
+def exit_in_parent(function):
+    """
+        Decorator for the multiprocessing helper functions, a sys.exit() in
+        the worker is raised as WorkerExit in the parent. The main() of the
+        tool exits with its message.
+    """
+    @wraps(function)
+    def worker(args):
+        try:
+            return function( args )
+        except SystemExit as error:
+            raise WorkerExit( error.code )
+    return worker
+
+
+class SiteBlock():
+    """
+        A block of consecutive methylation sites from one BED6 file.
+
+        The lines are split into their fields with one str.split() call. The
+        columns are created from the fields the first time they are used,
+        e.g. --min-coverage needs only the coverage. The chromosome and
+        strand columns are lists, the numeric columns numpy arrays.
+    """
+    def __init__(self, lines, columns = None, fields = None):
+        self.lines = lines
+        self.fields = fields
+        if columns is not None:
+            for name, column in izip( COLUMNS, columns ):
+                setattr( self, name, column )
+        elif fields is None:
+            self.fields = ''.join( lines ).split()
+            if len(self.fields) != 6 * len(lines):
+                for line in lines:
+                    if len( line.split() ) != 6:
+                        sys.exit('Some lines did not have 6 columns (chrom, start, end, coverage, methylation, strand).\n%s\n' % line.strip())
+
+    def __getattr__(self, name):
+        # only called for missing attributes, the columns are created on first use
+        if name not in COLUMN_TYPES or self.__dict__.get('fields') is None:
+            raise AttributeError(name)
+        column = self.fields[ COLUMNS.index(name)::6 ]
+        if COLUMN_TYPES[name] is not None:
+            column = parse_column( column, COLUMN_TYPES[name] )
+        setattr( self, name, column )
+        return column
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __repr__(self):
+        if not len(self):
+            return 'SiteBlock: empty'
+        return 'SiteBlock: %s sites, %s:%s - %s:%s' % (len(self), self.chrom[0], self.start[0], self.chrom[-1], self.end[-1])
+
+    def column_list(self, name):
+        """
+            Returns the column name as list, the text of the lines if the
+            block was read from lines.
+        """
+        if self.fields is not None:
+            return self.fields[ COLUMNS.index(name)::6 ]
+        column = getattr( self, name )
+        if isinstance(column, np.ndarray):
+            return column.tolist()
+        return column
+
+    def first_difference(self, other):
+        """
+            Returns the index of the first site that has another chromosome,
+            start, end or strand in the SiteBlock other, None if both blocks
+            contain the same sites.
+        """
+        index = None
+        for name in ['chrom', 'start', 'end', 'strand']:
+            mine = self.column_list( name )
+            theirs = other.column_list( name )
+            if mine != theirs:
+                differing = next( (i for i, (a, b) in enumerate( izip(mine, theirs) ) if a != b), min(len(mine), len(theirs)) )
+                index = differing if index is None else min(index, differing)
+        return index
+
+    def subset(self, index):
+        """
+            Returns a new SiteBlock with the sites selected by index, which
+            can be a slice or a boolean mask.
+        """
+        if isinstance(index, slice):
+            index = np.arange( len(self) )[ index ]
+        else:
+            index = np.flatnonzero( index )
+        lines = [self.lines[i] for i in index.tolist()]
+        fields = None
+        if self.fields is not None:
+            fields = [self.fields[i] for i in (6 * index[:, None] + np.arange(6)).ravel().tolist()]
+        block = SiteBlock( lines, fields = fields )
+        for name in COLUMNS:
+            if name in self.__dict__:
+                column = self.__dict__[name]
+                setattr( block, name, column[index] if isinstance(column, np.ndarray) else [column[i] for i in index.tolist()] )
+        return block
+
+
+def parse_column(values, dtype):
+    """
+        Arguments:
+            values -- list of numbers as text
+            dtype -- numpy dtype of the column
+
+        Return:
+            numpy array, all values are parsed with one call of np.fromstring()
+
+        >>> parse_column(['14', '6', '30'], float).tolist()
+        [14.0, 6.0, 30.0]
+    """
+    if not values:
+        return np.zeros( 0, dtype=dtype )
+    column = np.fromstring( ' '.join(values), dtype=dtype, sep=' ' )
+    if len(column) != len(values):
+        # raises the ValueError of the first value that is not a number
+        column = np.array( values, dtype=dtype )
+    return column
+
+
+
+def read_blocks(handle, block_size = BLOCK_SIZE):
+    """
+        Arguments:
+            handle -- iterable over the lines of a BED6 file
+            block_size -- number of sites in one block
+
+        Return:
+            iterator over SiteBlock objects, empty lines and header lines
+            starting with # are skipped. Every block but the last one has
+            block_size sites, independent of the number of skipped lines.
+    """
+    end_of_file = False
+    while not end_of_file:
+        lines = list()
+        while len(lines) < block_size:
+            chunk = list( islice(handle, block_size - len(lines)) )
+            if not chunk:
+                end_of_file = True
+                break
+            lines.extend( [line for line in chunk if line[0] not in '#\r\n'] )
+        if lines:
+            yield SiteBlock( lines )
+
+
+def aligned_blocks(control_handle, affected_handle, block_size = BLOCK_SIZE):
+    """
+        Arguments:
+            control_handle, affected_handle -- intersected BED6 files
+            block_size -- number of lines in one block
+
+        Return:
+            iterator over (control, affected) SiteBlock pairs
+
+        Both files needs to be intersected, so that each site is present in
+        both files. See intersected_blocks().
+    """
+    return intersected_blocks( [control_handle, affected_handle], block_size )
+
+
+def intersected_blocks(handles, block_size = BLOCK_SIZE):
+    """
+        Arguments:
+            handles -- list of intersected BED6 files
+            block_size -- number of lines in one block
+
+        Return:
+            iterator over tuples with one SiteBlock per file
+
+        All files needs to be intersected, so that each site is present in
+        every file. The coordinates of each block are compared with the block
+        of the first file at once and the program exits with the first
+        differing site. If the blocks differ in length, the remaining sites
+        are carried over to the next block. Like izip(), the iteration stops
+        with the end of the shortest file.
+    """
+    readers = [read_blocks(handle, block_size) for handle in handles]
+    pending = [None] * len(readers)
+    while True:
+        for index, reader in enumerate( readers ):
+            if pending[index] is None:
+                pending[index] = next( reader, None )
+                if pending[index] is None:
+                    return
+        length = min( len(block) for block in pending )
+        blocks = tuple( block if len(block) == length else block.subset( slice(0, length) ) for block in pending )
+        pending = [None if len(block) == length else block.subset( slice(length, None) ) for block in pending]
+        first = blocks[0]
+        for other in blocks[1:]:
+            i = first.first_difference( other )
+            if i is not None:
+                sys.exit('That file needs intersected inputfiles, so that each site is present in all files.\n %s : %s \n %s : %s \n %s : %s \n %s : %s \n' % tuple( value for name in ['chrom', 'start', 'end', 'strand'] for value in (first.column_list(name)[i], other.column_list(name)[i]) ))
+        yield blocks
+
+
+def read_chrom_order(path):
+    """
+        Arguments:
+            path -- file with one chromosome name per line in the first column, e.g. a genome file
+
+        Return:
+            list of chromosome names in the order of the file
+    """
+    chrom_order = list()
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                chrom_order.append( line.split()[0] )
+    return chrom_order
+
+
+def chrom_rank_function(chrom_order = None):
+    """
+        Returns a function that maps a chromosome name to a sortable rank,
+        following chrom_order or the lexicographic order if chrom_order is None.
+    """
+    if chrom_order:
+        ranks = dict( (chrom, index) for index, chrom in enumerate(chrom_order) )
+        # chromosomes that are not part of chrom_order are expected at the end
+        return lambda chrom: (ranks.get(chrom, len(ranks)), chrom)
+    else:
+        return lambda chrom: chrom
+
+
+def _site_groups(handle, chrom_rank):
+    """
+        Yields (key, lines) tuples for a sorted BED6 file, the key is
+        (chromosome rank, start) and lines is a list of (strand, line)
+        tuples. The same start position can occur on both strands and
+        the order of these sites depends on the sort program, so all lines
+        with the same key are grouped together.
+    """
+    last_chrom = None
+    last_rank = None
+    last_start = -1
+    seen_chroms = set()
+    group = list()
+    for line in handle:
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) < 6:
+            if line.strip():
+                sys.exit('Some lines did not have 6 columns (chrom, start, end, coverage, methylation, strand).\n%s\n' % line.strip())
+            continue
+        chrom = fields[0]
+        start = int( fields[1] )
+        if chrom != last_chrom:
+            rank = chrom_rank( chrom )
+            if last_chrom != None and rank < last_rank or chrom in seen_chroms:
+                sys.exit('The file %s is not sorted in the expected chromosome order: %s follows %s.\n' % (getattr(handle, 'name', ''), chrom, last_chrom))
+            if group:
+                yield (last_rank, last_start), group
+                group = list()
+            seen_chroms.add( chrom )
+            last_chrom = chrom
+            last_rank = rank
+        elif start != last_start:
+            if start < last_start:
+                sys.exit('The file %s is not sorted by start position: %s %s follows %s.\n' % (getattr(handle, 'name', ''), chrom, start, last_start))
+            if group:
+                yield (rank, last_start), group
+                group = list()
+        last_start = start
+        group.append( (fields[5], line) )
+    if group:
+        yield (last_rank, last_start), group
+
+
+def joined_lines(handles, chrom_order = None):
+    """
+        Arguments:
+            handles -- list of sorted BED6 files
+            chrom_order -- list of chromosome names, default is lexicographic order
+
+        Return:
+            iterator over tuples with one line of each file
+
+        Sort-merge join of all files, only sites that are present in all files
+        are returned. Sites are identified by chromosome, start and strand.
+    """
+    chrom_rank = chrom_rank_function( chrom_order )
+    iterators = [_site_groups(handle, chrom_rank) for handle in handles]
+    try:
+        heads = [iterator.next() for iterator in iterators]
+        while True:
+            max_key = max( key for key, group in heads )
+            matched = True
+            for index, iterator in enumerate( iterators ):
+                while heads[index][0] < max_key:
+                    heads[index] = iterator.next()
+                if heads[index][0] != max_key:
+                    matched = False
+            if matched:
+                groups = [dict(group) for key, group in heads]
+                for strand, line in heads[0][1]:
+                    if all( strand in group for group in groups ):
+                        yield tuple( group[ strand ] for group in groups )
+                heads = [iterator.next() for iterator in iterators]
+    except StopIteration:
+        # one of the files is exhausted, no common sites are left
+        return
+
+
+def joined_blocks(handles, chrom_order = None, block_size = BLOCK_SIZE):
+    """
+        Arguments:
+            handles -- list of sorted BED6 files
+            chrom_order -- list of chromosome names, default is lexicographic order
+            block_size -- number of sites in one block
+
+        Return:
+            iterator over tuples with one SiteBlock per file, all blocks
+            contain the same sites
+    """
+    joined = joined_lines( handles, chrom_order )
+    while True:
+        rows = list( islice(joined, block_size) )
+        if not rows:
+            break
+        yield tuple( SiteBlock( list(lines) ) for lines in izip(*rows) )
+
+
+def read_range(path, byte_range = None):
+    """
+        Arguments:
+            path -- path to a text file
+            byte_range -- (start, end) tuple, start needs to be the beginning
+                of a line; None reads the whole file
+
+        Return:
+            iterator over all lines that start in byte_range
+    """
+    if byte_range is None:
+        return open(path)
+    return chain.from_iterable( _range_lines(path, byte_range) )
+
+
+def _range_lines(path, byte_range, buffer_size = 8 * 1024 * 1024):
+    """
+        Yields lists with the lines of byte_range, the range is read in
+        buffers and each buffer is completed to the end of its last line.
+    """
+    start, end = byte_range
+    with open(path) as handle:
+        handle.seek( start )
+        position = start
+        while position < end:
+            data = handle.read( min(buffer_size, end - position) )
+            if not data:
+                break
+            if not data.endswith('\n'):
+                data += handle.readline()
+            position += len(data)
+            lines = data.split('\n')
+            last = lines.pop()
+            lines = [line + '\n' for line in lines]
+            if last:
+                lines.append( last )
+            yield lines
+
+
+def _line_start(handle, offset):
+    """
+        Returns the offset of the first line that starts at or after offset.
+    """
+    if offset <= 0:
+        return 0
+    handle.seek( offset - 1 )
+    handle.readline()
+    return handle.tell()
+
+
+def find_site(handle, key, chrom_rank):
+    """
+        Arguments:
+            handle -- sorted BED6 file, opened for reading
+            key -- (chromosome rank, start) tuple
+            chrom_rank -- function from chrom_rank_function()
+
+        Return:
+            byte offset of the first line with a key greater or equal key
+
+        Binary search over the byte offsets of a sorted file.
+    """
+    handle.seek( 0, os.SEEK_END )
+    low, high = 0, handle.tell()
+    while low < high:
+        middle = (low + high) // 2
+        handle.seek( _line_start(handle, middle) )
+        line = handle.readline()
+        while line and (not line.strip() or line.startswith('#')):
+            line = handle.readline()
+        if not line:
+            high = middle
+            continue
+        chrom, start = line.split('\t', 2)[:2]
+        if (chrom_rank(chrom), int(start)) >= key:
+            high = middle
+        else:
+            low = middle + 1
+    return _line_start( handle, low )
+
+
+def _site_line_starts(handle, buffer_size = 16 * 1024 * 1024):
+    """
+        Returns an iterator over arrays with the byte offsets of the lines
+        with a methylation site, empty lines and lines starting with # are
+        skipped like in read_blocks(). The file is read in buffers and the
+        line starts of each buffer are found with numpy.
+    """
+    handle.seek(0)
+    position = 0
+    line_start = True
+    while True:
+        data = handle.read( buffer_size )
+        if not data:
+            break
+        array = np.frombuffer( data, dtype=np.uint8 )
+        starts = np.flatnonzero( array[:-1] == ord('\n') ) + 1
+        if line_start:
+            starts = np.concatenate( ([0], starts) )
+        first = array[ starts ]
+        yield position + starts[ (first != ord('#')) & (first != ord('\n')) & (first != ord('\r')) ]
+        line_start = array[-1] == ord('\n')
+        position += len(data)
+
+
+def _count_lines(handle, offsets, buffer_size = 16 * 1024 * 1024):
+    """
+        Returns the number of site lines before each of the sorted offsets.
+    """
+    counts = np.zeros( len(offsets), dtype=np.int64 )
+    for starts in _site_line_starts( handle, buffer_size ):
+        counts += np.searchsorted( starts, offsets, side='left' )
+    return counts.tolist()
+
+
+def _line_offsets(handle, line_numbers, buffer_size = 16 * 1024 * 1024):
+    """
+        Returns the byte offset of each of the sorted site line numbers, the
+        end of the file for line numbers behind the last site.
+    """
+    offsets = list()
+    lines = 0
+    for starts in _site_line_starts( handle, buffer_size ):
+        while len(offsets) < len(line_numbers) and line_numbers[ len(offsets) ] < lines + len(starts):
+            offsets.append( int( starts[ line_numbers[ len(offsets) ] - lines ] ) )
+        lines += len(starts)
+    handle.seek( 0, os.SEEK_END )
+    size = handle.tell()
+    return offsets + [size] * (len(line_numbers) - len(offsets))
+
+
+def split_ranges(control_file, affected_file, chunks, join = False, chrom_order = None):
+    """
+        Arguments:
+            control_file, affected_file -- paths to the BED6 files
+            chunks -- number of chunks
+            join -- True if the files are not intersected, see joined_lines()
+            chrom_order -- list of chromosome names, default is lexicographic order
+
+        Return:
+            list of (control byte range, affected byte range) tuples
+
+        Splits both files into chunks that start at line boundaries and cover
+        the same sites, so that each chunk pair can be processed on its own.
+        Intersected files are split at the same site line numbers, header
+        lines are not counted, joined files at the same site, which is
+        searched with a binary search in both files.
+    """
+    with open(control_file) as control, open(affected_file) as affected:
+        control.seek( 0, os.SEEK_END )
+        control_size = control.tell()
+        affected.seek( 0, os.SEEK_END )
+        affected_size = affected.tell()
+
+        offsets = sorted( set( _line_start(control, control_size * i // chunks) for i in xrange(1, chunks) ) - set([0, control_size]) )
+        if join:
+            chrom_rank = chrom_rank_function( chrom_order )
+            control_offsets = list()
+            affected_offsets = list()
+            for offset in offsets:
+                control.seek( offset )
+                line = control.readline()
+                while line and (not line.strip() or line.startswith('#')):
+                    line = control.readline()
+                if not line:
+                    control_offsets.append( control_size )
+                    affected_offsets.append( affected_size )
+                    continue
+                chrom, start = line.split('\t', 2)[:2]
+                key = (chrom_rank(chrom), int(start))
+                control_offsets.append( find_site(control, key, chrom_rank) )
+                affected_offsets.append( find_site(affected, key, chrom_rank) )
+        else:
+            control_offsets = offsets
+            affected_offsets = _line_offsets( affected, _count_lines(control, offsets) )
+
+    control_offsets = [0] + control_offsets + [control_size]
+    affected_offsets = [0] + affected_offsets + [affected_size]
+    ranges = list()
+    for i in xrange( len(control_offsets) - 1 ):
+        control_range = (control_offsets[i], control_offsets[i + 1])
+        affected_range = (affected_offsets[i], affected_offsets[i + 1])
+        if control_range[0] < control_range[1] or affected_range[0] < affected_range[1]:
+            ranges.append( (control_range, affected_range) )
+    return ranges
+
+
+def chromosome_ranges(path):
+    """
+        Arguments:
+            path -- BED file, all lines of one chromosome need to be consecutive
+
+        Return:
+            list of (chromosome, (start, end)) tuples in file order, start
+            and end are byte offsets
+
+        The end of each chromosome is found with a binary search over the
+        byte offsets, so only a few lines per chromosome are read.
+    """
+    def read_chrom(handle, offset):
+        handle.seek( offset )
+        line = handle.readline()
+        while line and (not line.strip() or line.startswith('#')):
+            line = handle.readline()
+        if not line:
+            return None
+        return line.split('\t', 1)[0]
+
+    ranges = list()
+    with open(path) as handle:
+        handle.seek( 0, os.SEEK_END )
+        size = handle.tell()
+        position = 0
+        while position < size:
+            chrom = read_chrom( handle, position )
+            if chrom is None:
+                break
+            low, high = position, size
+            while low < high:
+                middle = (low + high) // 2
+                if read_chrom( handle, _line_start(handle, middle) ) != chrom:
+                    high = middle
+                else:
+                    low = middle + 1
+            end = _line_start( handle, low )
+            ranges.append( (chrom, (position, end)) )
+            position = end
+    return ranges
@@ -1,11 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import os
 import argparse
 import sys
-import sqlalchemy
-import StringIO
-from contextlib import closing
+import tempfile
+import shutil
+import zipfile
+import multiprocessing
+import numpy as np
+from itertools import izip
+from methtools.sites import chromosome_ranges, read_range, WorkerExit, exit_in_parent
+from methtools.intervals import IntervalIndex
+from methtools.genome import read_genome_file, load_genome, genome_from_bam, read_genome_header
 
 __doc__ = """
     Example methylation call bed file (it needs to be sorted):
@@ -32,17 +39,46 @@ __doc__ = """
 
         mysql --user=genome --host=genome-mysql.cse.ucsc.edu -A -e "select chrom, size from mm10.chromInfo" > mm10.genome
 
+        With --organism-tag the genome file is taken from the local genome
+        cache or the genomes bundled with methtools, only unknown organisms
+        are downloaded. See "methtools genome --help".
+
     There are two calculation modes:
         mean methylation -> sum( all methylation sites ) / count( methylation sites )
         methylation density -> sum( all methylation sites ) / window_length, where window_length is count( nucleotides ) in a window
 
-        Default mode is mean methylation and if --density is set methylation density mode is on.
+        coverage weighted methylation -> sum( methylation * coverage ) / sum( coverage ), that is methylated reads / reads
+
+        Default mode is mean methylation, --density and --weighted switch the mode.
+        With --counts the number of methylation sites and the summed coverage of each window are appended as columns.
 
     Example program call for mouse genome mm10 and a control.bed file with window length 1000 and step-size 500:
         ./tiling.py -g mm10.genome -i control_sorted.bed -w 1000 -s 500 -o control_w1000_s500.bed
+
+    Compact genome wide bedgraph, consecutive windows with the same value are one line:
+        ./tiling.py -g mm10.genome -i control_sorted.bed -m --all-windows --output-format rle -o control.bedgraph
+
+    bigWig track for genome browsers, the zoom levels are calculated from the windows:
+        ./tiling.py -g mm10.genome -i control_sorted.bed -m --output-format bigwig -o control.bw
+
+    Mean, density, weighted methylation, site count and coverage of promoter regions:
+        ./tiling.py -i control_sorted.bed --regions promoters.bed -o control_promoters.tsv
+
+    Window x sample matrix of several methylation call files, the window
+    borders are calculated once per chromosome:
+        ./tiling.py -g mm10.genome --samples control.bed affected.bed -m -w 1000 -s 500 -o matrix.tsv
 """
 
-def create_window_broders(window_length, step_size, chrom_size):
+# number of windows that are calculated at once
+WINDOW_CHUNK = 1000000
+# number of output lines that are formatted at once
+FORMAT_CHUNK = 100000
+# each zoom level of a track combines that many bins of the previous level
+ZOOM_FACTOR = 4
+ZOOM_LEVELS = 10
+
+
+def window_border_arrays(window_length, step_size, chrom_size):
     """
         Arguments:
             window_length -- size of the window
@@ -50,253 +86,1050 @@ def create_window_broders(window_length, step_size, chrom_size):
             chrom_size -- size of a chromosome
 
         Return:
-            iteratable of window borders -> [(0,1000), (500, 1500) ... ]
+            (starts, stops) arrays of the window borders, the last window
+            ends with the chromosome and is shorter than window_length
 
-        Creates a iteratable with tuples.
-        Each tuple represents the borders of a window.
+        >>> window_border_arrays(1000, 500, 2300)
+        (array([   0,  500, 1000, 2000]), array([1000, 1500, 2000, 2300]))
     """
-    start = None
-    for window in zip(xrange(0, chrom_size, step_size), xrange(window_length, chrom_size, step_size)):
-        start = window[1]
-        yield window
-    # return the last window with the exact end of the chromosome, that window is not window_length long but shorter
-    if start:
-        yield (start, chrom_size)
-
-    # if no accurate mapping to chrom_size is found we end up here and need to raise an error
-    yield (None, None)
+    if chrom_size <= window_length:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    count = (chrom_size - window_length - 1) // step_size + 1
+    starts = np.arange(count + 1, dtype=np.int64) * step_size
+    stops = starts + window_length
+    # the last window starts at the end of the previous window and ends with the chromosome
+    starts[-1] = stops[-2]
+    stops[-1] = chrom_size
+    return starts, stops
 
 
-class Windows():
+class ChromCalls():
     """
-        Main class to handle the sliding windows and corresponding functions.
+        All methylation calls of consecutive lines with the same chromosome,
+        stored as arrays.
     """
-    def __init__(self,options, chrom, genome_size):
-        self.start = None
-        self.stop = None
+    def __init__(self, chrom, rows):
         self.chrom = chrom
-        self._windows = create_window_broders( options.window_length, options.step_size, genome_size.get(chrom, -1))
-        self.density = {
-                '+': {},
-                '-': {},
-                }
-
-    def new_window(self):
-        self.start, self.stop = self._windows.next()
-        if self.start == None and self.stop == None:
-            """ the chromosome tag is probably not correct, so the end of one 
-            chromosome given in the genome file does not fit with the 
-            coordinates from the input file
-            """
-            sys.stderr.write('Given chromosome tag does not fit with the given coordinates.\n')
-            sys.exit()
-
-        # delete scores that do not belong to our window
-        for base_position in self.density['+'].keys():
-            if base_position < self.start:
-                del self.density['+'][ base_position ]
-        for base_position in self.density['-'].keys():
-            if base_position < self.start:
-                del self.density['-'][ base_position ]
-
-    def update_desity(self, score, strand, base_position):
-        try:
-            assert not self.density[ strand ].has_key( base_position )
-        except AssertionError:
-            sys.stderr.write( 'Found douplicate base position: %s %s\n' % (self.chrom, base_position) )
-            self.density[ strand ][ base_position ] += score
-            return
-        self.density[ strand ][ base_position ] = score
-
-    def density_sum(self, strand = False):
-        if not strand:
-            return self._sum_density( self.density['+'] ) + self._sum_density( self.density['-'] )
+        base_starts, names, scores, strands = zip( *rows )
+        self.positions = np.array(base_starts, dtype=np.int64)
+        self.names = names
+        self.scores = np.array(scores, dtype=float)
+        self.strands = np.array(strands)
+        self.decimals = fixed_point_decimals( scores, self.scores )
+        self._coverage = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def coverage(self):
+        """
+            Returns the coverage of the sites, see coverage_values.
+        """
+        if self._coverage is None:
+            self._coverage = coverage_values( self.names )
+        return self._coverage
+
+    def __repr__(self):
+        return 'ChromCalls: %s with %s methylation sites' % (self.chrom, len(self))
+
+
+def fixed_point_decimals(texts, scores):
+    """
+        Arguments:
+            texts -- score columns of the bed file
+            scores -- the parsed scores
+
+        Return:
+            the number of decimal places of the scores, if their sums can be
+            calculated exactly with integers, otherwise None
+
+        >>> fixed_point_decimals(['85.71', '6.7', '100'], np.array([85.71, 6.7, 100.]))
+        2
+    """
+    joined = '\n'.join( texts )
+    if 'e' in joined or 'E' in joined or 'n' in joined or 'N' in joined:
+        return None
+    decimals = 0
+    if '.' in joined:
+        lengths = np.array( map( len, map( str.rstrip, texts ) ) )
+        points = np.array( map( str.find, texts, ['.'] * len(texts) ) )
+        decimals = int( (lengths - points - 1)[points >= 0].max() )
+    if decimals > 9 or np.abs(scores).sum() * 10 ** decimals >= 2 ** 53:
+        return None
+    return decimals
+
+
+def coverage_values(names):
+    """
+        Returns the coverage of the methylation sites as array, taken from
+        the name column. The name is either the coverage or a text that ends
+        with it, NaN if it is no number.
+
+        >>> coverage_values(['14', 'methylation with a coverage of 30', '-']).tolist()
+        [14.0, 30.0, nan]
+    """
+    try:
+        return np.array( names, dtype=float )
+    except ValueError:
+        coverage = np.empty( len(names) )
+        for index, name in enumerate( names ):
+            try:
+                coverage[index] = float( name.rsplit(None, 1)[-1] )
+            except (ValueError, IndexError):
+                coverage[index] = np.nan
+        return coverage
+
+
+def read_chromosomes(handle):
+    """
+        Arguments:
+            handle -- sorted methylation call bed file
+
+        Return:
+            iterator over ChromCalls objects, one for each block of consecutive
+            lines with the same chromosome
+    """
+    chrom = None
+    rows = list()
+    for line in handle:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            line_chrom, base_start, base_end, name, score, strand = line.split('\t')
+            if line_chrom != chrom:
+                if rows:
+                    yield ChromCalls( chrom, rows )
+                chrom = line_chrom
+                rows = list()
+            rows.append( (int(base_start), name, score, strand) )
+    if rows:
+        yield ChromCalls( chrom, rows )
+
+
+class StrandSums():
+    """
+        Cumulative sums of the scores and of the different base positions of
+        the methylation sites of one strand. The sum and the site count of a
+        window are the differences of the cumulative sums at the window
+        borders, which are found with a binary search.
+        If the scores have only a few decimal places the cumulative sums are
+        calculated with integers, so the window sums are exact and do not
+        depend on the size of the chromosome.
+        With the coverage of the sites the coverage and the coverage weighted
+        scores are summed up as well.
+    """
+    def __init__(self, positions, scores, decimals, coverage = None):
+        self.positions = positions
+        # douplicate base positions are summed up but counted only once
+        first = np.ones( len(positions), dtype=bool )
+        first[1:] = positions[1:] != positions[:-1]
+        self.distinct = np.concatenate( ([0], np.cumsum( first )) )
+        self.decimals = decimals
+        if decimals is not None:
+            self.cumulative = np.concatenate( ([0], np.cumsum( np.rint( scores * 10 ** decimals ).astype(np.int64) )) )
         else:
-            return self._sum_density( self.density[strand] )
+            self.cumulative = np.concatenate( ([0], np.cumsum( scores, dtype=np.longdouble )) )
+        self.coverage = None
+        if coverage is not None:
+            self.coverage = np.concatenate( ([0], np.cumsum( coverage, dtype=np.longdouble )) )
+            self.weighted = np.concatenate( ([0], np.cumsum( scores * coverage, dtype=np.longdouble )) )
 
-    def _sum_density(self, density_dict):
-        sum = 0.0
-        for value in density_dict.values():
-            sum += value
-        return sum
+    def __len__(self):
+        return len(self.positions)
 
-    def get_methylation_sites_count(self, strand = False):
-        if not strand:
-            return len( self.density['+'].keys() ) + len( self.density['-'].keys() )
+    def window_sums(self, starts, stops):
+        """
+            Arguments:
+                starts, stops -- window borders
+
+            Return:
+                (sums, counts, weighted_sums, coverage) arrays with the summed
+                score, the number of different base positions, the summed
+                score * coverage and the summed coverage in each window. The
+                last two are None without coverage.
+        """
+        low = np.searchsorted( self.positions, starts, side='left' )
+        high = np.searchsorted( self.positions, stops, side='left' )
+        counts = self.distinct[high] - self.distinct[low]
+        if self.decimals is not None:
+            sums = (self.cumulative[high] - self.cumulative[low]) / float(10 ** self.decimals)
         else:
-            return len( self.density[strand].keys() )
+            sums = (self.cumulative[high] - self.cumulative[low]).astype(float)
+        if self.coverage is None:
+            return sums, counts, None, None
+        weighted_sums = (self.weighted[high] - self.weighted[low]).astype(float)
+        coverage = (self.coverage[high] - self.coverage[low]).astype(float)
+        return sums, counts, weighted_sums, coverage
+
+
+def strand_sums(calls, used, coverage = False):
+    """
+        Arguments:
+            calls -- ChromCalls of one chromosome
+            used -- number of sites that are used
+            coverage -- sum up the coverage of the name column as well
+
+        Return:
+            [StrandSums of the forward strand, StrandSums of the reverse strand]
+
+        Writes a warning for each douplicate base position.
+    """
+    positions = calls.positions[:used]
+    strands = calls.strands[:used]
+    scores = calls.scores[:used]
+    site_coverage = None
+    if coverage:
+        site_coverage = calls.coverage()[:used]
+    sums = list()
+    duplicates = list()
+    for strand in ['+', '-']:
+        index = np.flatnonzero( strands == strand )
+        strand_positions = positions[index]
+        sums.append( StrandSums( strand_positions, scores[index], calls.decimals, None if site_coverage is None else site_coverage[index] ) )
+        duplicates.extend( index[1:][ strand_positions[1:] == strand_positions[:-1] ].tolist() )
+    if len(sums[0]) + len(sums[1]) != used:
+        unknown = np.flatnonzero( (strands != '+') & (strands != '-') )[0]
+        sys.exit('Unknown strand %s in %s at %s.' % (strands[unknown], calls.chrom, positions[unknown]))
+    for index in sorted( duplicates ):
+        sys.stderr.write( 'Found douplicate base position: %s %s\n' % (calls.chrom, positions[index]) )
+    return sums
+
+
+class Resolution():
+    """
+        Window length, step size and output file of one tiling resolution.
+    """
+    def __init__(self, window_length, step_size, handle):
+        self.window_length = window_length
+        self.step_size = step_size
+        self.handle = handle
+        # set if a methylation site did not fit into the windows, in that case the output stops
+        self.stopped = False
+
+    def __repr__(self):
+        return 'Resolution: window length %s, step size %s' % (self.window_length, self.step_size)
+
+
+def resolution_argument(text):
+    """
+        argparse type for WINDOW_LENGTH:STEP_SIZE arguments, without step
+        size the windows do not overlap.
 
+        >>> resolution_argument('1000:500')
+        (1000, 500)
+        >>> resolution_argument('50000')
+        (50000, 50000)
+    """
+    try:
+        if ':' in text:
+            window_length, step_size = text.split(':')
+            return int(window_length), int(step_size)
+        return int(text), int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not of the form WINDOW_LENGTH:STEP_SIZE' % text)
+
+
+def format_rows( line_format, columns ):
+    """
+        Arguments:
+            line_format -- format string of one line with one %s per column
+            columns -- lists of the column values, all of the same length
+
+        Return:
+            iterator over text blocks with line_format % row for each row
+
+        The lines of FORMAT_CHUNK rows are formatted with one format string,
+        that is much faster than formatting each line on its own.
+
+        >>> ''.join( format_rows( 'chr1\\t%s\\t%s\\n', [[0, 500], [0.5, 1.0]] ) )
+        'chr1\\t0\\t0.5\\nchr1\\t500\\t1.0\\n'
+    """
+    width = len(columns)
+    for low in xrange( 0, len(columns[0]), FORMAT_CHUNK ):
+        chunk = [column[low:low + FORMAT_CHUNK] for column in columns]
+        fields = [None] * (width * len(chunk[0]))
+        for index, column in enumerate( chunk ):
+            fields[index::width] = column
+        yield (line_format * len(chunk[0])) % tuple(fields)
+
+
+def chrom_format( chrom, columns ):
+    """
+        Returns the format string of an output line of chrom with that many
+        %s columns behind the chromosome name.
+
+        >>> chrom_format( 'chr1', 3 )
+        'chr1\\t%s\\t%s\\t%s\\n'
+    """
+    return chrom.replace('%', '%%') + '\t%s' * columns + '\n'
+
+
+def interleave( forward, reverse ):
+    """
+        Returns an array with the values of both strands of each window,
+        forward first.
+
+        >>> interleave( np.array([1, 2]), np.array([3, 4]) ).tolist()
+        [1, 3, 2, 4]
+    """
+    values = np.empty( 2 * len(forward), dtype=forward.dtype )
+    values[0::2] = forward
+    values[1::2] = reverse
+    return values
+
+
+def window_values(sums, denominators):
+    """
+        Returns sums / denominators and 0.0 for windows without sites.
+    """
+    values = np.zeros( len(sums) )
+    np.divide( sums, denominators, out=values, where=denominators > 0 )
+    return values
+
+
+def merged_values( options, starts, stops, strand_sums ):
+    """
+        Arguments:
+            options -- tiling options
+            starts, stops -- window borders
+            strand_sums -- window_sums of the forward and the reverse strand
 
-def read_genome_file(genome_path):
+        Return:
+            (values, written) arrays with the value of each window, both
+            strands summed up, and a mask of the windows with methylation sites
+    """
+    (sums_forward, counts_forward, weighted_forward, coverage_forward), (sums_reverse, counts_reverse, weighted_reverse, coverage_reverse) = strand_sums
+    density = sums_forward + sums_reverse
+    counts = counts_forward + counts_reverse
+    if options.density:
+        # methylation density
+        values = window_values( density, stops - starts )
+    elif options.weighted:
+        # coverage weighted methylation
+        values = window_values( weighted_forward + weighted_reverse, coverage_forward + coverage_reverse )
+    else:
+        # mean methylation
+        values = window_values( density, counts )
+    values[density == 0.0] = 0.0
+    # if we have no methylation state in that window and the option to write such states into the result file is False we do not wirte it
+    written = (density != 0.0) | (counts != 0)
+    return values, written
+
+
+def write_runs( handle, chrom, starts, stops, values, indexes, run ):
+    """
+        Arguments:
+            handle -- output file
+            chrom -- chromosome name
+            starts, stops, values -- windows and their values
+            indexes -- index of each window in the chromosome
+            run -- (start, stop, value, index) of the unfinished run of the
+                previous windows or None
+
+        Return:
+            the unfinished run at the end of the windows
+
+        Writes consecutive windows with the same value as one bedgraph line
+        from the start of the first to the stop of the last window. Only the
+        run borders are searched and formatted, not every window.
+    """
+    if run is not None:
+        start, stop, value, index = run
+        starts, stops, values, indexes = [np.concatenate( ([first], rest) ) for first, rest in [(start, starts), (stop, stops), (value, values), (index, indexes)]]
+    if not len(starts):
+        return run
+    breaks = np.ones( len(starts), dtype=bool )
+    breaks[1:] = (values[1:] != values[:-1]) | (indexes[1:] != indexes[:-1] + 1)
+    run_starts = np.flatnonzero( breaks )
+    run_stops = np.append( run_starts[1:], len(starts) ) - 1
+    handle.writelines( format_rows( chrom_format( chrom, 3 ), [starts[run_starts[:-1]].tolist(), stops[run_stops[:-1]].tolist(), values[run_starts[:-1]].tolist()] ) )
+    return starts[run_starts[-1]].item(), stops[run_stops[-1]].item(), values[run_starts[-1]].item(), indexes[run_stops[-1]].item()
+
+
+def fixed_step_header( chrom, window_length, step_size, chrom_size, window_count ):
+    """
+        Returns the header line of the windows of one chromosome in the
+        binary fixed step format.
+
+        >>> fixed_step_header( 'chr1', 1000, 500, 2000, 3 )
+        'fixedStep chrom=chr1 start=0 step=500 span=1000 size=2000 count=3\\n'
+    """
+    return 'fixedStep chrom=%s start=0 step=%s span=%s size=%s count=%s\n' % (chrom, step_size, window_length, chrom_size, window_count)
+
+
+def read_fixed_step( handle ):
     """
         Arguments:
-            genome_path -- file like object
+            handle -- file in the binary fixed step format (--output-format binary)
 
         Return:
-            dictionary with chromosome name <-> size mapping
-
-        Reads a genome file into a dictionary. 
-        The genome file in needed to know the borders of each chromosom to 
-        adjust the windows properly.
-        closing() is needed, because if the user specified an organism_tag the
-        genome_path will be a StringIO Stream, which has no close definition.
-    """
-    genome_dict = dict()
-    with closing(genome_path) as handle:
-        for line in handle:
-            line = line.strip()
-            if line:
-                chrom, size = line.split('\t')
-                try:
-                    size = int(size)
-                except:
-                    continue
-                genome_dict[chrom] = size
-    return genome_dict
-
-
-def write_to_bedfile( options, chrom, name, window ):
-    """
-        Write one line to the options.output result file.
+            iterator over (chrom, step_size, window_length, chrom_size, values)
+            tuples, one for each chromosome. The window i starts at
+            i * step_size and ends window_length later, the last window
+            starts at the end of the previous one and ends at the end of the
+            chromosome (see window_border_arrays).
+
+        The format is a text header line per chromosome (see
+        fixed_step_header) followed by the window values as count
+        little-endian float32 numbers.
+    """
+    for header in iter( handle.readline, '' ):
+        fields = dict( field.split('=', 1) for field in header.split()[1:] )
+        count = int( fields['count'] )
+        values = np.fromstring( handle.read( 4 * count ), dtype='<f4' )
+        yield fields['chrom'], int(fields['step']), int(fields['span']), int(fields['size']), values
+
+
+def write_windows( options, handle, chrom, starts, stops, names, strand_sums ):
+    """
+        Writes the windows of one chromosome to handle.
         Depending on the options.all_windows the result file is either in BED or in bedgraph format.
 
-        There are two calculation modes:
+        There are three calculation modes:
             mean methylation -> sum over all methylation sites / #methylation sites
             methylation density -> sum over all methylation sites / window_length, where window_length is #nucleotides
+            coverage weighted methylation -> sum over all methylation sites of methylation * coverage / sum of the coverage,
+                which is the number of methylated reads / number of reads
 
-            Default mode is mean methylation and if --density is set methylation density mode is on.
+            Default mode is mean methylation, --density and --weighted switch the mode.
+            With --counts the number of methylation sites and the summed coverage are appended as columns.
     """
-    window_length = (window.stop - window.start)
+    window_length = stops - starts
+    (sums_forward, counts_forward, weighted_forward, coverage_forward), (sums_reverse, counts_reverse, weighted_reverse, coverage_reverse) = strand_sums
     if options.merge_strands:
+        values, written = merged_values( options, starts, stops, strand_sums )
+        counts = counts_forward + counts_reverse
+        if not options.all_windows:
+            starts, stops, values, counts = starts[written], stops[written], values[written], counts[written]
+        columns = [starts, stops, values]
+        if options.counts:
+            coverage = coverage_forward + coverage_reverse
+            if not options.all_windows:
+                coverage = coverage[written]
+            columns.extend( [counts, coverage] )
+        handle.writelines( format_rows( chrom_format( chrom, len(columns) ), [column.tolist() for column in columns] ) )
 
-        density = window.density_sum()
+    else:
         if options.density:
             # methylation density
-            denominator = window_length
+            values_forward = window_values( sums_forward, window_length )
+            values_reverse = window_values( sums_reverse, window_length )
+        elif options.weighted:
+            # coverage weighted methylation
+            values_forward = window_values( weighted_forward, coverage_forward )
+            values_reverse = window_values( weighted_reverse, coverage_reverse )
         else:
             # mean methylation
-            denominator = window.get_methylation_sites_count()
+            values_forward = window_values( sums_forward, counts_forward )
+            values_reverse = window_values( sums_reverse, counts_reverse )
+
+        # one line per strand and window, the forward strand first
+        written = interleave( sums_forward != 0.0, sums_reverse != 0.0 ) | options.all_windows
+        windows = np.repeat( np.arange( len(starts) ), 2 )[written]
+        columns = [starts[windows].tolist(), stops[windows].tolist(), map( names.__getitem__, windows.tolist() ),
+            interleave( values_forward, values_reverse )[written].tolist(), np.tile( ['+', '-'], len(starts) )[written].tolist()]
+        if options.counts:
+            columns.append( interleave( counts_forward, counts_reverse )[written].tolist() )
+            columns.append( interleave( coverage_forward, coverage_reverse )[written].tolist() )
+        handle.writelines( format_rows( chrom_format( chrom, len(columns) ), columns ) )
+
+
+def tile_chromosome( options, resolutions, calls, chrom_size, next_name ):
+    """
+        Arguments:
+            options -- tiling options
+            resolutions -- list of Resolution objects
+            calls -- ChromCalls of one chromosome
+            chrom_size -- size of the chromosome from the genome file
+            next_name -- name column of the line after the chromosome
+
+        The windows from the start of the chromosome up to the window of the
+        last methylation site are written. The name column of a window is
+        taken from the first line behind that window.
+        If a methylation site is not inside of the windows, all windows up
+        to the end of the chromosome are written and the output of that
+        resolution stops. That happens as well for chromosomes without
+        windows, e.g. they are missing in the genome file.
+        All resolutions use the same cumulative sums of the chromosome.
+    """
+    positions = calls.positions
+    if (options.weighted or options.counts) and np.isnan( calls.coverage() ).any():
+        sys.exit('--weighted and --counts need the coverage of the methylation sites in the name column (%s).' % calls.chrom)
+    chrom_sums = None
+    for resolution in resolutions:
+        if resolution.stopped:
+            continue
+        starts, stops = window_border_arrays( resolution.window_length, resolution.step_size, chrom_size )
+
+        # the first window that ends behind the site, every site needs to be inside of that window
+        window_index = np.searchsorted( stops, positions, side='right' )
+        valid = window_index < len(starts)
+        valid[valid] = starts[ window_index[valid] ] <= positions[valid]
+        valid[1:] &= positions[1:] >= positions[:-1]
+        invalid = np.flatnonzero( ~valid )
 
-        if density == 0.0 and not options.all_windows and window.get_methylation_sites_count() == 0:
-            # if we have no methylation state in that window and the option to write such states into the result file is False we do not wirte it
-            return True
-        elif density == 0.0:
-            options.outfile.write( '%s\t%s\t%s\t%s\n' % (chrom, window.start, window.stop, '0.0') )
+        names = list( calls.names )
+        if len(invalid):
+            # all windows are written with the sites up to the invalid one
+            used = invalid[0]
+            if used and positions[used] < positions[used - 1]:
+                sys.stderr.write('The methylation sites of %s are not sorted.\n' % calls.chrom)
+            names = names[:used + 1]
+            window_count = len(starts)
+            sums = strand_sums( calls, used, options.weighted or options.counts )
         else:
-            options.outfile.write( '%s\t%s\t%s\t%s\n' % (chrom, window.start, window.stop, density / denominator) )
+            used = len(positions)
+            names.append( next_name )
+            window_count = window_index[-1] + 1
+            if chrom_sums is None:
+                chrom_sums = strand_sums( calls, used, options.weighted or options.counts )
+            sums = chrom_sums
 
-    else:
-        density_forward = window.density_sum('+')
-        density_reverse = window.density_sum('-')
+        if options.output_format == 'binary':
+            resolution.handle.write( fixed_step_header( calls.chrom, resolution.window_length, resolution.step_size, chrom_size, window_count ) )
+        run = None
+        for low in xrange( 0, window_count, WINDOW_CHUNK ):
+            high = min( low + WINDOW_CHUNK, window_count )
+            chunk_starts, chunk_stops = starts[low:high], stops[low:high]
+            chunk_sums = [strand.window_sums( chunk_starts, chunk_stops ) for strand in sums]
+            if options.output_format == 'text':
+                chunk_names = [names[i] for i in np.minimum( np.searchsorted( positions[:used], chunk_stops, side='left' ), len(names) - 1 ).tolist()]
+                write_windows( options, resolution.handle, calls.chrom, chunk_starts, chunk_stops, chunk_names, chunk_sums )
+                continue
+            values, written = merged_values( options, chunk_starts, chunk_stops, chunk_sums )
+            if options.output_format == 'binary':
+                # all windows, empty ones are 0.0
+                resolution.handle.write( values.astype('<f4').tostring() )
+            else:
+                indexes = np.arange( low, high )
+                if not options.all_windows:
+                    chunk_starts, chunk_stops, values, indexes = chunk_starts[written], chunk_stops[written], values[written], indexes[written]
+                run = write_runs( resolution.handle, calls.chrom, chunk_starts, chunk_stops, values, indexes, run )
+        if run is not None:
+            start, stop, value, index = run
+            resolution.handle.write( '%s\t%s\t%s\t%s\n' % (calls.chrom, start, stop, value) )
+
+        if len(invalid):
+            """ the chromosome tag is probably not correct, so the end of one
+            chromosome given in the genome file does not fit with the
+            coordinates from the input file
+            """
+            sys.stderr.write('Given chromosome tag does not fit with the given coordinates.\n')
+            resolution.stopped = True
+
+
+@exit_in_parent
+def run_tiling( args ):
+    """
+        Multiprocessing helper function.
+        Tiles one chromosome of the input file into one temporary file per
+        resolution and returns the (path, stopped) tuples of the resolutions.
+    """
+    options, temp_dir, path, chrom, byte_range, chrom_size, next_name = args
+    resolutions = list()
+    temp_paths = list()
+    for window_length, step_size in options.resolution_sizes:
+        handle, temp_path = tempfile.mkstemp( dir = temp_dir, suffix = '.bed' )
+        resolutions.append( Resolution( window_length, step_size, os.fdopen( handle, 'w' ) ) )
+        temp_paths.append( temp_path )
+    for calls in read_chromosomes( read_range(path, byte_range) ):
+        if calls.chrom != chrom:
+            sys.exit('The sites of the chromosome %s are not consecutive in the input file. Please sort the file.' % chrom)
+        tile_chromosome( options, resolutions, calls, chrom_size, next_name or calls.names[-1] )
+    for resolution in resolutions:
+        resolution.handle.close()
+    return [(temp_path, resolution.stopped) for temp_path, resolution in izip( temp_paths, resolutions )]
+
+
+def parallel_tiling( options, resolutions, genome_size ):
+    """
+        Windows never span chromosomes, so each chromosome is tiled on its
+        own in a process pool. The chromosomes are located with a binary
+        search in the input file and written in the order of the genome
+        file, chromosomes that are not in the genome file at last. Like in
+        the sequential mode the output of a resolution stops at the first
+        chromosome with a site outside of the windows.
+    """
+    path = options.infile.name
+    if not os.path.isfile( path ):
+        sys.exit('--processors needs an input file, the standard input can not be split into chromosomes.')
+    ranges = chromosome_ranges( path )
+    # the last window of a chromosome is named after the first line of the next chromosome
+    next_names = list()
+    for chrom, byte_range in ranges[1:]:
+        for calls in read_chromosomes( read_range(path, byte_range) ):
+            next_names.append( calls.names[0] )
+            break
+    next_names.append( None )
+
+    genome_order = dict( (chrom, index) for index, chrom in enumerate( genome_size ) )
+    jobs = sorted( izip( ranges, next_names ), key = lambda job: genome_order.get( job[0][0], len(genome_order) ) )
+
+    worker_options = argparse.Namespace( **vars(options) )
+    worker_options.infile = None
+    worker_options.outfile = None
+    worker_options.resolution_sizes = [(resolution.window_length, resolution.step_size) for resolution in resolutions]
+
+    temp_dir = tempfile.mkdtemp()
+    pool = multiprocessing.Pool( options.processors )
+    try:
+        jobs = [(worker_options, temp_dir, path, chrom, byte_range, genome_size.get(chrom, -1), next_name) for (chrom, byte_range), next_name in jobs]
+        for results in pool.imap( run_tiling, jobs ):
+            for resolution, (temp_path, stopped) in izip( resolutions, results ):
+                if not resolution.stopped:
+                    with open( temp_path ) as handle:
+                        shutil.copyfileobj( handle, resolution.handle )
+                    resolution.stopped = stopped
+                os.remove( temp_path )
+    finally:
+        # the pool is terminated as well if a worker exits
+        pool.terminate()
+        pool.join()
+        # cleaning temporary working directory
+        shutil.rmtree( temp_dir )
+
+
+def read_sample(path, byte_range):
+    """
+        Returns the ChromCalls of one chromosome of a sample file, the
+        chromosome is the byte range of the file.
+    """
+    for calls in read_chromosomes( read_range(path, byte_range) ):
+        if calls.positions.size > 1 and (calls.positions[1:] < calls.positions[:-1]).any():
+            sys.exit('The methylation sites of %s in %s are not sorted.' % (calls.chrom, path))
+        return calls
+    return None
+
+
+def sample_values( options, calls, starts, stops ):
+    """
+        Arguments:
+            options -- tiling options
+            calls -- ChromCalls of one sample and chromosome
+            starts, stops -- window borders
 
+        Return:
+            array with the values of each window, NaN for windows without
+            methylation sites. The array has one column with --merge-strands
+            and otherwise two, forward and reverse strand.
+    """
+    window_length = stops - starts
+    strand_values = list()
+    if options.weighted and np.isnan( calls.coverage() ).any():
+        sys.exit('--weighted needs the coverage of the methylation sites in the name column (%s).' % calls.chrom)
+    sums = [strand.window_sums( starts, stops ) for strand in strand_sums( calls, len(calls), options.weighted )]
+    if options.merge_strands:
+        if options.weighted:
+            sums = [[sum_forward + sum_reverse for sum_forward, sum_reverse in izip( *sums )]]
+        else:
+            (sums_forward, counts_forward, weighted_forward, coverage_forward), (sums_reverse, counts_reverse, weighted_reverse, coverage_reverse) = sums
+            sums = [(sums_forward + sums_reverse, counts_forward + counts_reverse, None, None)]
+    for window_sum, counts, weighted_sum, coverage in sums:
         if options.density:
-            # methylation density
-            denominator_forward = window_length
-            denominator_reverse = window_length
+            values = window_values( window_sum, window_length )
+        elif options.weighted:
+            values = window_values( weighted_sum, coverage )
         else:
-            # mean methylation
-            denominator_forward = window.get_methylation_sites_count('+')
-            denominator_reverse = window.get_methylation_sites_count('-')
+            values = window_values( window_sum, counts )
+        values[counts == 0] = np.nan
+        strand_values.append( values )
+    return np.column_stack( strand_values )
+
+
+class NpzWriter():
+    """
+        Writes a numpy .npz file whose arrays are appended row by row, e.g.
+        chromosome by chromosome. The rows of each array are collected in a
+        temporary file and the .npz file is written at close, so only the
+        appended rows need to fit into memory.
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.temp_dir = tempfile.mkdtemp()
+        # name -> [raw file, dtype, shape of one row, rows]
+        self.arrays = dict()
+        self.names = list()
+
+    def append(self, name, array):
+        if name not in self.arrays:
+            self.arrays[name] = [open( os.path.join( self.temp_dir, '%s.raw' % name ), 'wb' ), array.dtype, array.shape[1:], 0]
+            self.names.append( name )
+        raw, dtype, shape, rows = self.arrays[name]
+        if array.dtype != dtype or array.shape[1:] != shape:
+            raise ValueError('The rows of %s need the dtype %s and the shape %s.' % (name, dtype, shape))
+        raw.write( np.ascontiguousarray( array ).tostring() )
+        self.arrays[name][3] += len(array)
+
+    def close(self, **arrays):
+        """
+            Writes the .npz file with the appended arrays and the arrays
+            given as keyword arguments.
+        """
+        with zipfile.ZipFile( self.handle, 'w', zipfile.ZIP_STORED, allowZip64 = True ) as archive:
+            for name, array in arrays.iteritems():
+                path = os.path.join( self.temp_dir, '%s.npy' % name )
+                np.save( path, array )
+                archive.write( path, '%s.npy' % name )
+            for name in self.names:
+                raw, dtype, shape, rows = self.arrays[name]
+                raw.close()
+                path = os.path.join( self.temp_dir, '%s.npy' % name )
+                with open( path, 'wb' ) as npy:
+                    np.lib.format.write_array_header_1_0( npy, {'descr': np.lib.format.dtype_to_descr( dtype ), 'fortran_order': False, 'shape': (rows,) + shape} )
+                    with open( raw.name, 'rb' ) as data:
+                        shutil.copyfileobj( data, npy )
+                os.remove( raw.name )
+                archive.write( path, '%s.npy' % name )
+                os.remove( path )
+        shutil.rmtree( self.temp_dir )
+
+
+def multi_sample_tiling( options, genome_size ):
+    """
+        Tiles all files of options.samples with the same windows and writes
+        one row per window (and strand) with one column per sample. The
+        chromosomes are processed in the order of the genome file, each one
+        is located in the sample files with a binary search, so every file is
+        read once. Windows without a methylation site in any sample are only
+        written with --all-windows, missing values are NA.
+        With --npz the matrix is written as numpy .npz file with the arrays
+        samples, chrom, start, stop, strand and values (windows x samples,
+        float32, NaN for missing values). It is written chromosome by
+        chromosome, so the memory only depends on the largest chromosome.
+    """
+    names = options.sample_names or [os.path.splitext( os.path.basename(path) )[0] for path in options.samples]
+    if len(names) != len(options.samples):
+        sys.exit('Please specify one sample name for each sample file.')
+    sample_ranges = [dict( chromosome_ranges(path) ) for path in options.samples]
+    for chrom in sorted( set().union( *sample_ranges ) - set(genome_size) ):
+        sys.stderr.write( 'Skip %s, the chromosome is not in the genome file.\n' % chrom )
+
+    if options.merge_strands:
+        strands = ['.']
+    else:
+        strands = ['+', '-']
+    if options.npz:
+        npz = NpzWriter( options.outfile )
+        chrom_dtype = 'S%s' % max( len(chrom) for chrom in genome_size )
+        matrix_dtype = np.float32
+        for name, empty in [('chrom', np.zeros( 0, dtype=chrom_dtype )), ('start', np.zeros( 0, dtype=np.int64 )), ('stop', np.zeros( 0, dtype=np.int64 )),
+                ('strand', np.array( [], dtype='S1' )), ('values', np.zeros( (0, len(names)), dtype=matrix_dtype ))]:
+            npz.append( name, empty )
+    else:
+        matrix_dtype = float
+        options.outfile.write( '#%s\n' % '\t'.join( ['chrom', 'start', 'stop'] + (['strand'] if not options.merge_strands else []) + names ) )
+
+    for chrom, chrom_size in genome_size.iteritems():
+        if not any( chrom in ranges for ranges in sample_ranges ):
+            continue
+        starts, stops = window_border_arrays( options.window_length, options.step_size, chrom_size )
+        # windows x strands x samples
+        matrix = np.empty( (len(starts), len(strands), len(options.samples)), dtype=matrix_dtype )
+        matrix.fill( np.nan )
+        for column, (path, ranges) in enumerate( izip(options.samples, sample_ranges) ):
+            calls = None
+            if chrom in ranges:
+                calls = read_sample( path, ranges[chrom] )
+            if calls is not None:
+                matrix[:, :, column] = sample_values( options, calls, starts, stops )
+
+        if not options.all_windows:
+            written = ~np.isnan( matrix ).all( axis=2 ).all( axis=1 )
+            starts, stops, matrix = starts[written], stops[written], matrix[written]
+
+        if options.npz:
+            npz.append( 'chrom', np.repeat( np.array( [chrom], dtype=chrom_dtype ), len(starts) * len(strands) ) )
+            npz.append( 'start', np.repeat( starts, len(strands) ) )
+            npz.append( 'stop', np.repeat( stops, len(strands) ) )
+            npz.append( 'strand', np.tile( np.array( strands ), len(starts) ) )
+            npz.append( 'values', matrix.reshape( -1, len(names) ) )
+            continue
+        for start, stop, rows in izip( starts.tolist(), stops.tolist(), matrix.tolist() ):
+            for strand, values in izip( strands, rows ):
+                coordinates = [chrom, str(start), str(stop)]
+                if not options.merge_strands:
+                    coordinates.append( strand )
+                options.outfile.write( '\t'.join( coordinates + ['NA' if value != value else str(value) for value in values] ) + '\n' )
+
+    if options.npz:
+        npz.close( samples = np.array( names ) )
+
+
+def write_regions( options, regions, chrom, calls ):
+    """
+        Writes the regions of one chromosome with the mean methylation, the
+        methylation density, the coverage weighted methylation, the number
+        of methylation sites and the summed coverage of all sites in each
+        region, the strands are merged.
+        All regions are looked up in the cumulative sums of the chromosome
+        with a binary search, so overlapping regions cost no additional pass.
+        Regions without sites are only written with --all-windows.
+    """
+    starts, stops, names = regions.starts[chrom], regions.ends[chrom], regions.names[chrom]
+    if calls is None:
+        sums, counts, weighted_sums, coverage = np.zeros( len(starts) ), np.zeros( len(starts), dtype=np.int64 ), np.zeros( len(starts) ), np.zeros( len(starts) )
+    else:
+        sums, counts, weighted_sums, coverage = [forward + reverse for forward, reverse in izip( *[strand.window_sums( starts, stops ) for strand in strand_sums( calls, len(calls), True )] )]
+    means = window_values( sums, counts )
+    densities = window_values( sums, stops - starts )
+    weighted = window_values( weighted_sums, coverage )
+
+    written = ((counts > 0) | options.all_windows).tolist()
+    for start, stop, name, mean, density, weighted_mean, count, region_coverage, write in izip( starts.tolist(), stops.tolist(), names, means.tolist(), densities.tolist(), weighted.tolist(), counts.tolist(), coverage.tolist(), written ):
+        if write:
+            if region_coverage != region_coverage:
+                # the name column has no coverage
+                weighted_mean, region_coverage = 'NA', 'NA'
+            options.outfile.write( '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (chrom, start, stop, name, mean, density, weighted_mean, count, region_coverage) )
+
+
+def region_tiling( options, meth_call_lines ):
+    """
+        Aggregates the methylation sites over the regions of a BED file
+        (promoters, CpG islands, ...) instead of sliding windows, the
+        regions may overlap. The input is read once, chromosome by
+        chromosome, and the regions of each chromosome are written sorted by
+        start position, in the chromosome order of the input file.
+        With --all-windows the regions on chromosomes without methylation
+        sites are written at last.
+    """
+    regions = IntervalIndex( options.regions )
+    options.outfile.write( '#chrom\tstart\tend\tname\tmean\tdensity\tweighted\tcount\tcoverage\n' )
+    seen = set()
+    for calls in read_chromosomes( meth_call_lines ):
+        if calls.chrom in seen:
+            sys.exit('The sites of the chromosome %s are not consecutive in the input file. Please sort the file.' % calls.chrom)
+        seen.add( calls.chrom )
+        if calls.chrom not in regions.starts:
+            continue
+        if len(calls) > 1 and (calls.positions[1:] < calls.positions[:-1]).any():
+            sys.exit('The methylation sites of %s are not sorted.' % calls.chrom)
+        write_regions( options, regions, calls.chrom, calls )
+    if options.all_windows:
+        for chrom in sorted( set(regions.starts) - seen ):
+            write_regions( options, regions, chrom, None )
+
+
+def chromosome_values( options, genome_size, meth_call_lines ):
+    """
+        Arguments:
+            options -- tiling options
+            genome_size -- dictionary with chromosome name <-> size mapping
+            meth_call_lines -- lines of a sorted methylation call file
+
+        Return:
+            iterator over (chrom, starts, stops, values, written) tuples with
+            all windows of each chromosome in the input file, their merged
+            values and a mask of the windows with methylation sites.
+            Sites outside of the windows are ignored.
+    """
+    for calls in read_chromosomes( meth_call_lines ):
+        if calls.chrom not in genome_size:
+            sys.stderr.write( 'Skip %s, the chromosome is not in the genome file.\n' % calls.chrom )
+            continue
+        if len(calls) > 1 and (calls.positions[1:] < calls.positions[:-1]).any():
+            sys.exit('The methylation sites of %s are not sorted.' % calls.chrom)
+        if options.weighted and np.isnan( calls.coverage() ).any():
+            sys.exit('--weighted needs the coverage of the methylation sites in the name column (%s).' % calls.chrom)
+        starts, stops = window_border_arrays( options.window_length, options.step_size, genome_size[calls.chrom] )
+        values, written = merged_values( options, starts, stops, [strand.window_sums( starts, stops ) for strand in strand_sums( calls, len(calls), options.weighted )] )
+        yield calls.chrom, starts, stops, values, written
+
+
+def reduce_zoom( sums, counts, minimums, maximums, factor = ZOOM_FACTOR ):
+    """
+        Arguments:
+            sums, counts, minimums, maximums -- bins of one chromosome
+            factor -- number of bins that are combined
+
+        Return:
+            (sums, counts, minimums, maximums) of the next coarser zoom level,
+            minimums and maximums of bins without sites are NaN
+
+        >>> [level.tolist() for level in reduce_zoom( np.array([1., 3., 0., 2., 6.]), np.array([1, 1, 0, 1, 2]), np.array([1., 3., np.nan, 2., 2.]), np.array([1., 3., np.nan, 2., 4.]), 2 )]
+        [[4.0, 2.0, 6.0], [2, 1, 2], [1.0, 2.0, 2.0], [3.0, 2.0, 4.0]]
+    """
+    if not len(sums):
+        return sums, counts, minimums, maximums
+    index = np.arange( 0, len(sums), factor )
+    return np.add.reduceat( sums, index ), np.add.reduceat( counts, index ), np.fmin.reduceat( minimums, index ), np.fmax.reduceat( maximums, index )
+
+
+def write_zoom_levels( handle, options, chromosomes ):
+    """
+        Writes the windows as multi zoom track in the numpy .npz format
+        (--output-format zoom), which needs no pyBigWig:
+
+            chroms, sizes -- chromosomes and their sizes
+            window_length, step_size, zoom_factor
+            offsets_<level> -- the bins of chromosome i are offsets[i]:offsets[i + 1]
+            sum_<level>, count_<level>, min_<level>, max_<level> -- summed
+                value, number of windows with sites, minimal and maximal
+                value of each bin
+
+        Level 0 are the windows, each bin of level n combines zoom_factor
+        bins of level n - 1 and starts with the window n * zoom_factor ** level.
+        The levels are reduced from the window arrays, see zoom_windows.
+    """
+    arrays = dict(
+        chroms = np.array( [chrom for chrom, chrom_size, starts, stops, values, written in chromosomes] ),
+        sizes = np.array( [chrom_size for chrom, chrom_size, starts, stops, values, written in chromosomes], dtype=np.int64 ),
+        window_length = options.window_length,
+        step_size = options.step_size,
+        zoom_factor = ZOOM_FACTOR,
+    )
+    levels = list()
+    for chrom, chrom_size, starts, stops, values, written in chromosomes:
+        minimums = np.where( written, values, np.nan )
+        levels.append( (values * written, written.astype(np.int64), minimums, minimums.copy()) )
+    for level in xrange( ZOOM_LEVELS ):
+        arrays['offsets_%s' % level] = np.concatenate( ([0], np.cumsum( [len(sums) for sums, counts, minimums, maximums in levels] )) )
+        for name, column in izip( ['sum', 'count', 'min', 'max'], izip( *levels ) ):
+            arrays['%s_%s' % (name, level)] = np.concatenate( list(column) + [np.zeros(0)] )
+        if max( [len(sums) for sums, counts, minimums, maximums in levels] + [0] ) <= 1:
+            break
+        levels = [reduce_zoom( *level ) for level in levels]
+    np.savez( handle, **arrays )
+
 
-        if density_forward != 0.0 or options.all_windows:
-            options.outfile.write( '%s\t%s\t%s\t%s\t%s\t%s\n' % (chrom, window.start, window.stop, name, density_forward / denominator_forward, '+') )
-        if density_reverse != 0.0 or options.all_windows:
-            options.outfile.write( '%s\t%s\t%s\t%s\t%s\t%s\n' % (chrom, window.start, window.stop, name, density_reverse / denominator_reverse, '-') )
+def zoom_windows( zoom, chrom, level ):
+    """
+        Arguments:
+            zoom -- the loaded .npz file of write_zoom_levels
+            chrom -- chromosome name
+            level -- zoom level, 0 are the windows
+
+        Return:
+            (starts, stops, means) arrays of the bins of one chromosome and
+            zoom level, the mean of bins without sites is NaN
+    """
+    index = zoom['chroms'].tolist().index( chrom )
+    low, high = zoom['offsets_%s' % level][index:index + 2]
+    starts, stops = window_border_arrays( int(zoom['window_length']), int(zoom['step_size']), int(zoom['sizes'][index]) )
+    factor = int(zoom['zoom_factor']) ** level
+    counts = zoom['count_%s' % level][low:high]
+    means = np.full( len(counts), np.nan )
+    np.divide( zoom['sum_%s' % level][low:high], counts, out=means, where=counts > 0 )
+    return starts[::factor], stops[ np.minimum( np.arange( factor - 1, len(stops) + factor - 1, factor ), len(stops) - 1 ) ], means
+
+
+def write_bigwig( path, options, chromosomes ):
+    """
+        Writes the windows as bigWig file with pyBigWig, which calculates the
+        zoom levels from the written windows. Overlapping windows are cut at
+        the start of the next window, because the entries of a bigWig file
+        can not overlap. Windows without sites are only written with
+        --all-windows.
+    """
+    import pyBigWig
+    bigwig = pyBigWig.open( path, 'w' )
+    bigwig.addHeader( [(chrom, chrom_size) for chrom, chrom_size, starts, stops, values, written in chromosomes], maxZooms = ZOOM_LEVELS )
+    for chrom, chrom_size, starts, stops, values, written in chromosomes:
+        ends = np.minimum( stops, np.append( starts[1:], stops[-1:] ) )
+        if not options.all_windows:
+            starts, ends, values = starts[written], ends[written], values[written]
+        if len(starts):
+            bigwig.addEntries( [chrom] * len(starts), starts.tolist(), ends = ends.tolist(), values = values.tolist() )
+    bigwig.close()
+
+
+def track_tiling( options, genome_size, meth_call_lines ):
+    """
+        Writes the windows as genome browser track with zoom levels, a
+        bigWig file (--output-format bigwig) or the .npz file of
+        write_zoom_levels (--output-format zoom). The chromosomes are written
+        in the order of the genome file.
+    """
+    chromosomes = dict( (chrom, (chrom, genome_size[chrom], starts, stops, values, written)) for chrom, starts, stops, values, written in chromosome_values( options, genome_size, meth_call_lines ) )
+    chromosomes = [chromosomes[chrom] for chrom in genome_size if chrom in chromosomes]
+    if options.output_format == 'bigwig':
+        options.outfile.close()
+        write_bigwig( options.outfile.name, options, chromosomes )
+    else:
+        write_zoom_levels( options.outfile, options, chromosomes )
 
 
 def tiling( options ):
+    # the #genome header lines of the input file are used if no other genome is given
+    if options.samples:
+        header_genome, meth_call_lines = read_genome_header( open(options.samples[0]) )
+    else:
+        header_genome, meth_call_lines = read_genome_header( options.infile )
+    if options.regions:
+        # the regions replace the windows, no genome is needed
+        with options.infile:
+            region_tiling( options, meth_call_lines )
+        options.outfile.close()
+        return
+
     if options.genome_file:
         genome_size = read_genome_file( open(options.genome_file) )
     elif options.organism_tag:
-        options.organism_tag = options.organism_tag.strip()
-        try:
-            engine = sqlalchemy.create_engine('mysql://genome@genome-mysql.cse.ucsc.edu')
-            output = engine.execute("select chrom, size from %s.chromInfo" % options.organism_tag)
-            output = ''.join(['%s\t%s\n' % (r[0],r[1]) for r in output])
-            genome_file = StringIO.StringIO( output )
-            genome_size = read_genome_file( genome_file )
-        except:
-            sys.exit('Fetching of the genome file failed! You need a working internet connection and mysql client installed.\nPlease download manually and specify it ith --genome_file.')
+        genome_size = load_genome( options.organism_tag, options.genome_cache )
+    elif options.genome_from_bam:
+        genome_size = genome_from_bam( options.genome_from_bam )
+    elif header_genome:
+        genome_size = header_genome
+    else:
+        sys.exit('Please specify a genome file, an organism tag or a BAM file, the input file has no #genome header lines.')
+
+    if options.density and options.weighted:
+        sys.exit('--density and --weighted can not be combined.')
+    if options.output_format != 'text' and (not options.merge_strands or options.counts or options.samples):
+        sys.exit('--output-format %s needs --merge-strands and can not be combined with --counts or --samples.' % options.output_format)
+    if options.output_format in ['bigwig', 'zoom']:
+        if options.resolutions or options.processors > 1:
+            sys.exit('--output-format %s can not be combined with --resolution or --processors.' % options.output_format)
+        if options.output_format == 'bigwig':
+            try:
+                import pyBigWig
+            except ImportError:
+                sys.exit('--output-format bigwig needs pyBigWig, please install it with "pip install pyBigWig" or write the zoom levels as .npz file with --output-format zoom.')
+            if options.outfile is sys.stdout:
+                sys.exit('A bigWig file can not be written to the standard output, please specify an --outfile.')
+        with options.infile:
+            track_tiling( options, genome_size, meth_call_lines )
+        options.outfile.close()
+        return
 
+    if options.samples:
+        if options.resolutions:
+            sys.exit('--samples can not be combined with --resolution.')
+        multi_sample_tiling( options, genome_size )
+        options.outfile.close()
+        return
+
+    if options.resolutions:
+        if not options.output_prefix:
+            sys.exit('Please specify an --output-prefix for the results of the resolutions.')
+        resolutions = [Resolution( window_length, step_size, open('%s_w%s_s%s.bed' % (options.output_prefix, window_length, step_size), 'w') )
+            for window_length, step_size in options.resolutions]
     else:
-        sys.exit('Please specify a genome file or an organism tag.')
-
-    window_start = 0
-    window_counter = 0
-    old_chrom = None
-    blacklist_chrom = False
-    with options.infile as meth_call:
-        # for every bedfile line
-        for line_counter, line in enumerate( meth_call ):
-            line = line.strip()
-            if line:
-                chrom, base_start, base_end, name, score, strand = line.split('\t')
-                base_start = int(base_start)
-                score = float(score)
-                if chrom == blacklist_chrom:
-                    continue
-                if chrom != old_chrom:
-                    # leave one window and create a new one, in fact leave the whole chromosome
-                    if old_chrom != None:
-                        # during the first iteration the old_chr is null, in that case do not write out the results
-                        write_to_bedfile( options, old_chrom, name, windows )
-                    windows = Windows( options, chrom, genome_size ) #create_window_broders( options.window_length, options.step_size, genome_size.get(chrom, -1))
-                    old_chrom = chrom
-
-                    blacklist_chrom = False
-
-                    windows.new_window()
-                    window_start = windows.start
-                    window_end = windows.stop
-                    """
-                        We get (None, None) if no mapping with to the chromosome
-                        size is found in genome_size, that happens when obscure 
-                        chromosome ids are present in the input files and not 
-                        in the genome-file
-                    """
-                    if window_start == None:
-                        blacklist_chrom = chrom
-                        old_chrom = None
-                        continue
-
-                if base_start >= window_start and base_start < window_end:
-                    windows.update_desity(score, strand, base_start)
-                else:
-                    # leave one window and create a new one
-                    write_to_bedfile( options, chrom, name, windows )
-
-                    windows.new_window()
-                    window_start = windows.start
-                    window_end = windows.stop
-
-                    #if window_start < 0:
-                    #    # happens when no chrom_size is present in the mapping file specified with the -g option
-                    #    continue
-                    while True:
-                        """
-                            iterate over all windows until the next methylation
-                            site pops up
-                        """
-                        if base_start >= window_start and base_start < window_end:
-                            windows.update_desity(score, strand, base_start)
-                            # leave the while loop
-                            break
-                        else:
-                            """
-                                in that window no mehtylation site exist
-                                write to output if options.all_windows is set
-                            """
-                            write_to_bedfile( options, chrom, name, windows )
-
-                        windows.new_window()
-                        window_start = windows.start
-                        window_end = windows.stop
-
-        if chrom != blacklist_chrom:
-            write_to_bedfile( options, chrom, name, windows )
+        resolutions = [Resolution( options.window_length, options.step_size, options.outfile )]
+
+    if options.processors > 1:
+        parallel_tiling( options, resolutions, genome_size )
+        for resolution in resolutions:
+            resolution.handle.close()
+        options.outfile.close()
+        return
+
+    with options.infile:
+        previous = None
+        for calls in read_chromosomes( meth_call_lines ):
+            if previous is not None:
+                tile_chromosome( options, resolutions, previous, genome_size.get(previous.chrom, -1), calls.names[0] )
+                if all( resolution.stopped for resolution in resolutions ):
+                    previous = None
+                    break
+            previous = calls
+        if previous is not None:
+            tile_chromosome( options, resolutions, previous, genome_size.get(previous.chrom, -1), previous.names[-1] )
 
+    for resolution in resolutions:
+        resolution.handle.close()
     options.outfile.close()
 
+
 def main():
     parser = argparse.ArgumentParser(
         description='Calcualtes methylation desity for a given sequence window.',
@@ -307,9 +1140,11 @@ def main():
     parser.add_argument('-o', '--outfile', type=argparse.FileType('w'),
                      default=sys.stdout)
 
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument('-g', '--genome_file', help="Genome file should tab delimited and structured as follows: <chrom name><TAB><chrom size>")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-g', '--genome_file', help="Genome file should tab delimited and structured as follows: <chrom name><TAB><chrom size>, additional columns are ignored, e.g. of a FASTA index (*.fai)")
     group.add_argument('--organism-tag', dest='organism_tag' ,help="If no genome file is specified we try to download the file with the unique organism identifier, e.g. mm10 or hg18")
+    group.add_argument('--genome-from-bam', dest='genome_from_bam', metavar='BAM', help="Take the chromosome sizes from the header of the BAM file the methylation calls are from. Without any genome option the #genome header lines of the input file are used (see calling --genome-header)")
+    parser.add_argument('--genome-cache', dest='genome_cache', default=None, help="Directory of the genome cache used with --organism-tag (default: $METHTOOLS_GENOME_CACHE or ~/.methtools/genomes)")
     parser.add_argument('-m','--merge-strands', dest='merge_strands', action='store_true', default=False, help='Sum up all methylation sites independent from the strand. In that case the output will be a BED-graph file.')
     parser.add_argument('--all-windows', dest="all_windows", action='store_true', default=False, help='Write also windows with no methylation sites to the result file - default: False')
     parser.add_argument('-w', '--window-length', dest="window_length", type=int, default=1000, help='Length of the sliding window - default: 1000')
@@ -317,9 +1152,40 @@ def main():
     parser.add_argument('--density', action='store_true', default=False, 
         help='Calculate the methylation density: Sum over all methylation sites / nucleotides (window_length). Default calculation mode is the mean methylation: Sum over all methylation sites / methylated sites')
 
+    parser.add_argument('--weighted', action='store_true', default=False,
+        help='Calculate the coverage weighted methylation: Sum over all methylation sites of methylation * coverage / summed coverage, the coverage is taken from the name column.')
+    parser.add_argument('--counts', action='store_true', default=False,
+        help='Append the number of methylation sites and the summed coverage of each window as columns, not with --samples.')
+
+    parser.add_argument('--output-format', dest='output_format', choices=['text', 'rle', 'binary', 'bigwig', 'zoom'], default='text',
+        help='Compact outputs of the merged strands (-m): rle writes consecutive windows with the same value as one bedgraph line, binary writes all windows of a chromosome as float32 numbers after a header line, see methtools.tiling.read_fixed_step. bigwig writes a bigWig file for genome browsers (needs pyBigWig), zoom writes the zoom levels as .npz file without pyBigWig, see methtools.tiling.write_zoom_levels (default: text)')
+
+    parser.add_argument('--resolution', dest='resolutions', metavar='W:S', type=resolution_argument, action='append', default=[],
+        help='Window length and step size of one resolution, can be given multiple times. All resolutions are calculated from one pass over the input file and written to <output-prefix>_w<W>_s<S>.bed, -w and -s are ignored.')
+    parser.add_argument('--output-prefix', dest='output_prefix', default=None, help='Path prefix of the result files of the --resolution options.')
+
+    parser.add_argument('-p', '--processors', type=int, default=1,
+        help='Tile the chromosomes in parallel, the output is written in the chromosome order of the genome file. Needs an input file (-i).')
+
+    parser.add_argument('--regions', default=None, metavar='BED',
+        help='Aggregate the methylation sites over the regions of a BED file (chrom, start, end, optional name) instead of sliding windows. Writes mean methylation, density, coverage weighted methylation, site count and coverage of each region, no genome file is needed.')
+
+    parser.add_argument('--samples', nargs='+', default=None, metavar='FILE',
+        help='Tile all sample files with the same windows and write a matrix with one column per sample instead of -i, the files need to be sorted.')
+    parser.add_argument('--sample-names', dest='sample_names', type=lambda text: text.split(','), default=None,
+        help='Comma separated column names of the --samples (default: file names without extension)')
+    parser.add_argument('--npz', action='store_true', default=False,
+        help='Write the --samples matrix as numpy .npz file to --outfile, see methtools.tiling.multi_sample_tiling.')
+
     options = parser.parse_args()
+    if options.samples and options.counts:
+        # the sample matrix has one value column per sample
+        parser.error('--counts can not be combined with --samples')
 
-    tiling(options)
+    try:
+        tiling(options)
+    except WorkerExit as error:
+        sys.exit( error.args[0] )
 
 if __name__ == '__main__':
     main()
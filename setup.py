@@ -19,6 +19,7 @@ setup(name = "methtools",
     author_email = __email__,
     description = "",
     packages = find_packages(),
+    package_data = {'methtools': ['genomes/*.genome']},
     #install_requires = ['foo>=0.4']
     entry_points = {
     'console_scripts': [ 
@@ -28,6 +29,7 @@ setup(name = "methtools",
         #'filter = filter:main',
         #'destrand = destrand:main',
         #'plot = plot:main',
+        #'genome = genome:main',
         'methtools = methtools:main'
         ]
         }
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os, sys
+import random
+import argparse
+import unittest
+import tempfile
+import shutil
+import StringIO
+import numpy as np
+from fractions import Fraction
+from methtools import dmr
+from methtools.dmr import ChromSites, Window, scan_chromosome, dmr_windows, parameter_list, optional_parameter_list
+from test_sites import site_files
+
+__doc__ = """
+    The incremental last-n and allow-failed checks of dmr.Window need to
+    call the same DMRs as the previous implementation, which summed up a
+    list of the last n sites for every new site, but with the mean of the
+    last n two decimal deltas compared exactly against
+    --min-delta-methylation. Neighbouring DMRs are only
+    merged with DMRs of the same direction. The --sweep-* lists accept none
+    only for constraints that can be disabled. With --join the files that
+    are not intersected give the same DMRs as the intersected files.
+
+    Run all tests from the top directory of the repository with
+        python -m unittest discover tests
+"""
+
+# two decimal deltas, some of their means hit the --min-delta-methylation
+# border of 25 exactly, where a float sum can round to either side
+DELTAS = [25.0, 24.99, 25.01, 33.33, 16.67, 8.33, 41.67, 12.5, 37.5, 0.1, 30.3, 19.7, 27.27, 22.73, -25.0, 0.0]
+
+
+class ListWindow(Window):
+    """
+        Window with the constraint checks of the previous implementation,
+        that built the list of the last n sites for each new site. The
+        mean of the deltas, as decimals, is calculated without rounding.
+    """
+    def _last_deltas(self, n):
+        if self.first is None or n <= 0:
+            return []
+        return self.deltas[ max(self.first, self.last - n + 1) : self.last + 1 ]
+
+    def _check_cpg(self, index):
+        delta = self.deltas[ index ]
+        if self.window_length:
+            if self.max_cpg_distance and (self.sites.end_values[ index ] - self.end) > self.max_cpg_distance:
+                return False
+
+        if self.min_single_delta_methylation != None:
+            if self.delta < 0 and delta > -self.min_single_delta_methylation:
+                return False
+            elif self.delta > 0 and delta < self.min_single_delta_methylation:
+                return False
+
+        if len(self) + 1 < self.min_window_length:
+            return True
+
+        if self.allow_failed != None:
+            last_deltas = self._last_deltas( self.allow_failed ) + [delta]
+            if len( [test for test in last_deltas if abs(test) < self.min_delta_methylation] ) > self.allow_failed:
+                return False
+
+        if self.last_n > 0:
+            last_deltas = self._last_deltas( self.last_n - 1 ) + [delta]
+            if abs( sum( Fraction('%.6f' % test) for test in last_deltas ) / len(last_deltas) ) < Fraction( self.min_delta_methylation ):
+                return False
+
+        return True
+
+
+def random_sites(seed, count = 20000):
+    random.seed( seed )
+    end = np.cumsum( [random.randint(1, 60) for i in xrange(count)] ) + 100
+    meth_control = np.array( [round(random.uniform(0, 50), 2) for i in xrange(count)] )
+    meth_affected = meth_control + np.array( [random.choice(DELTAS) for i in xrange(count)] )
+    coverage = np.ones( count ) * 10
+    return ChromSites( 'chr1', end - 1, end, coverage, meth_control, coverage, meth_affected )
+
+
+def dmr_options(check_last_n, allow_failed = None):
+    return argparse.Namespace( min_window_length = 4, max_cpg_distance = None, min_delta_methylation = 25,
+        min_single_delta_methylation = None, check_last_n = check_last_n, allow_failed = allow_failed )
+
+
+class TestWindowChecks(unittest.TestCase):
+
+    def assertSameWindows(self, sites, options):
+        windows = [(win.first, win.last) for win in scan_chromosome( sites, options )]
+        # scan_chromosome creates the windows, so the class is swapped for the reference run
+        dmr.Window = ListWindow
+        try:
+            expected = [(win.first, win.last) for win in scan_chromosome( sites, options )]
+        finally:
+            dmr.Window = Window
+        self.assertEqual( expected, windows )
+
+    def test_last_n(self):
+        for seed in xrange(1, 7):
+            sites = random_sites( seed )
+            for check_last_n in [1, 3, 4]:
+                self.assertSameWindows( sites, dmr_options(check_last_n) )
+
+    def test_allow_failed(self):
+        for seed in xrange(1, 7):
+            sites = random_sites( seed )
+            for check_last_n, allow_failed in [(5, 0), (5, 1), (4, 2)]:
+                self.assertSameWindows( sites, dmr_options(check_last_n, allow_failed) )
+
+
+def layout_sites(layout):
+    """
+        Returns ChromSites with sites every 10 bp, layout is a list of
+        (number of sites, control methylation, affected methylation) tuples.
+    """
+    meth_control = np.concatenate( [[control] * count for count, control, affected in layout] ).astype(float)
+    meth_affected = np.concatenate( [[affected] * count for count, control, affected in layout] ).astype(float)
+    end = np.arange( 1, len(meth_control) + 1 ) * 10 + 91
+    coverage = np.ones( len(end) ) * 10
+    return ChromSites( 'chr1', end - 1, end, coverage, meth_control, coverage, meth_affected )
+
+
+class TestMergeWindows(unittest.TestCase):
+
+    # hyper, hypo and hyper DMR, the hyper DMRs are 49 bp apart and the
+    # mean delta over all three is still 34.29
+    sites = layout_sites( [(5, 20, 80), (4, 50, 20), (5, 20, 80)] )
+
+    def windows(self, sites, hyper = False, hypo = False, merge_gap = None):
+        options = argparse.Namespace( min_window_length = 4, max_cpg_distance = None, min_delta_methylation = 25,
+            min_single_delta_methylation = 20, check_last_n = 4, allow_failed = None,
+            hyper = hyper, hypo = hypo, merge_gap = merge_gap, merge_cpg_gap = None )
+        return [(win.start, win.end, round(win.delta, 2)) for win in dmr_windows( sites, options )]
+
+    def test_opposite_direction(self):
+        expected = [(100, 141, 60.0), (150, 181, -30.0), (190, 231, 60.0)]
+        self.assertEqual( self.windows( self.sites ), expected )
+        self.assertEqual( self.windows( self.sites, merge_gap = 100 ), expected )
+
+    def test_hyper_hypo_selection(self):
+        # the hypo DMR separates both hyper DMRs, even if only hyper DMRs are written
+        self.assertEqual( self.windows( self.sites, hyper = True, merge_gap = 100 ), [(100, 141, 60.0), (190, 231, 60.0)] )
+        self.assertEqual( self.windows( self.sites, hypo = True, merge_gap = 100 ), [(150, 181, -30.0)] )
+
+    def test_same_direction(self):
+        sites = layout_sites( [(5, 20, 80), (2, 40, 40), (5, 20, 80)] )
+        self.assertEqual( self.windows( sites, hyper = True, merge_gap = 100 ), [(100, 211, 50.0)] )
+
+
+def write_sites(path, sites, meth):
+    with open(path, 'w') as handle:
+        for start, end, value in zip( sites.start, sites.end, meth ):
+            handle.write( 'chr1\t%s\t%s\t10\t%.2f\t+\n' % (start, end, value) )
+
+
+def run_dmr(arguments):
+    """
+        Runs dmr.main() with the command line arguments, returns the exit
+        code and stderr.
+    """
+    argv, stderr = sys.argv, sys.stderr
+    sys.argv = ['dmr'] + arguments
+    sys.stderr = StringIO.StringIO()
+    try:
+        dmr.main()
+        code = 0
+    except SystemExit as error:
+        code = error.code
+    finally:
+        sys.argv, sys.stderr, message = argv, stderr, sys.stderr.getvalue()
+    return code, message
+
+
+class TestSweepParameters(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.control = os.path.join( self.directory, 'control.bed' )
+        self.affected = os.path.join( self.directory, 'affected.bed' )
+        self.summary = os.path.join( self.directory, 'summary.tsv' )
+        sites = TestMergeWindows.sites
+        write_sites( self.control, sites, sites.meth_control )
+        write_sites( self.affected, sites, sites.meth_affected )
+
+    def tearDown(self):
+        shutil.rmtree( self.directory )
+
+    def sweep(self, *arguments):
+        return run_dmr( ['--control', self.control, '--affected', self.affected, '-o', self.summary,
+            '--sweep', os.path.join(self.directory, 'sweep')] + list(arguments) )
+
+    def test_parameter_list(self):
+        self.assertEqual( parameter_list('20, 25,30'), [20, 25, 30] )
+        self.assertEqual( optional_parameter_list('none,0,NONE'), [None, 0, None] )
+        self.assertRaises( argparse.ArgumentTypeError, parameter_list, 'none' )
+        self.assertRaises( argparse.ArgumentTypeError, optional_parameter_list, '1.5' )
+
+    def test_none_rejected(self):
+        for option in ['--sweep-min-delta-methylation', '--sweep-check-last-n']:
+            code, message = self.sweep( option, '4,none' )
+            self.assertEqual( code, 2 )
+            self.assertTrue( 'none is not allowed' in message )
+
+    def test_none_accepted(self):
+        code, message = self.sweep( '--sweep-allow-failed', 'none,1', '--sweep-max-cpg-distance', 'none,5' )
+        self.assertEqual( code, 0 )
+        summary = [line.rstrip('\n').split('\t') for line in open(self.summary) if not line.startswith('#')]
+        self.assertEqual( [row[2:4] for row in summary], [['none', 'none'], ['none', '5'], ['1', 'none'], ['1', '5']] )
+        # each setting calls the same DMRs as a single run with these options
+        single = os.path.join( self.directory, 'single.bed' )
+        for row in summary:
+            arguments = ['--control', self.control, '--affected', self.affected, '-o', single]
+            for option, value in zip( ['--allow-failed', '--max-cpg-distance'], row[2:4] ):
+                if value != 'none':
+                    arguments += [option, value]
+            self.assertEqual( run_dmr( arguments ), (0, '') )
+            self.assertEqual( open(row[-1]).read(), open(single).read() )
+            self.assertEqual( int(row[4]), len( open(single).readlines() ) )
+
+
+class TestJoin(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.directory )
+
+    def write(self, name, lines):
+        path = os.path.join( self.directory, name )
+        with open(path, 'w') as handle:
+            handle.writelines( lines )
+        return path
+
+    def dmrs(self, control, affected, *arguments):
+        outfile = os.path.join( self.directory, 'dmrs.bed' )
+        self.assertEqual( run_dmr( ['--control', control, '--affected', affected, '-o', outfile, '--min-delta-methylation', '10'] + list(arguments) ), (0, '') )
+        return open(outfile).read()
+
+    def test_join(self):
+        chrom_order = ['chr2', 'chr10', 'chr1']
+        for seed, order in [(5, None), (6, chrom_order)]:
+            paths = [self.write( name, lines ) for name, lines in zip( ['control.bed', 'affected.bed', 'control_common.bed', 'affected_common.bed'], site_files( seed, order ) )]
+            expected = self.dmrs( paths[2], paths[3] )
+            self.assertTrue( expected )
+            arguments = ['--join']
+            if order:
+                arguments += ['--chrom-order', self.write( 'chroms.txt', [chrom + '\n' for chrom in order] )]
+            self.assertEqual( self.dmrs( paths[0], paths[1], *arguments ), expected )
+            self.assertEqual( self.dmrs( paths[0], paths[1], '-p', '2', *arguments ), expected )
+
+
+if __name__ == '__main__':
+    unittest.main()
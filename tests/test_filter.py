@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os, sys
+import random
+import unittest
+import tempfile
+import shutil
+import StringIO
+import numpy as np
+from methtools.filter import filtering, fisher_pvalues, float32_pvalues, pvalue_bins, bh_qvalues, PVALUE_BINS
+from test_sites import site_files
+
+__doc__ = """
+    The --fdr qvalues of filter are derived from a fixed size pvalue
+    histogram. They need to stay within the bin width above the exact
+    Benjamini-Hochberg qvalues of all tested sites. With --join the files
+    that are not intersected give the same result as the intersected files.
+
+    Run all tests from the top directory of the repository with
+        python -m unittest discover tests
+"""
+
+# relative width of a pvalue bin, see pvalue_bins(), plus the float32 rounding
+BIN_WIDTH = 2.0 ** -11 + 2.0 ** -23
+# absolute width of the bins of pvalues below the normal float32 range
+SUBNORMAL_BIN_WIDTH = 2.0 ** -137
+
+
+def exact_qvalues(pvalues):
+    """
+        Returns the Benjamini-Hochberg qvalue of each pvalue,
+        min( p_(j) * m / j ) over all ranks j >= the rank of the pvalue.
+    """
+    pvalues = np.asarray( pvalues, dtype=float )
+    m = len(pvalues)
+    order = np.argsort( pvalues, kind='mergesort' )
+    ranked = pvalues[order] * m / np.arange( 1, m + 1 )
+    ranked = np.minimum.accumulate( ranked[::-1] )[::-1]
+    qvalues = np.empty( m )
+    qvalues[order] = np.minimum( ranked, 1.0 )
+    return qvalues
+
+
+def binned_qvalues(pvalues):
+    """
+        Returns the qvalue of each pvalue as filter --fdr calculates it.
+    """
+    bins = pvalue_bins( float32_pvalues( pvalues ) )
+    return bh_qvalues( np.bincount( bins, minlength = PVALUE_BINS ) )[bins]
+
+
+def filter_files(directory, control_lines, affected_lines, **arguments):
+    """
+        Runs filtering() on the lines, returns the lines of the filtered
+        control file and of the --oqvalues file.
+    """
+    paths = [os.path.join( directory, name ) for name in ['control.bed', 'affected.bed', 'ocontrol.bed', 'oaffected.bed', 'qvalues.bed']]
+    for path, lines in zip( paths, [control_lines, affected_lines] ):
+        with open(path, 'w') as handle:
+            handle.writelines( lines )
+    if arguments.get('fdr') != None:
+        arguments['qvalue_file'] = open( paths[4], 'w' )
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        filtering( paths[0], paths[1], open(paths[2], 'w'), open(paths[3], 'w'), **arguments )
+    finally:
+        sys.stdout = stdout
+    qvalue_lines = list()
+    if arguments.get('fdr') != None:
+        qvalue_lines = open(paths[4]).readlines()
+    return open(paths[2]).readlines(), qvalue_lines
+
+
+def filter_both(directory, control_lines, affected_lines, **arguments):
+    """
+        Runs filtering() on the lines, returns the lines of both filtered files.
+    """
+    filtered_control, qvalue_lines = filter_files( directory, control_lines, affected_lines, **arguments )
+    return filtered_control, open( os.path.join( directory, 'oaffected.bed' ) ).readlines()
+
+
+def random_lines(seed, count = 400):
+    """
+        Returns intersected control and affected lines with a few strongly
+        differential sites and many similar ones.
+    """
+    random.seed( seed )
+    control = list()
+    affected = list()
+    for index in xrange( count ):
+        start = index * 10
+        control_meth = random.choice( [0, 10, 20, 50, 80] )
+        affected_meth = control_meth + random.choice( [0, 0, 0, 10, -10, 60, -60] )
+        affected_meth = min( max( affected_meth, 0 ), 100 )
+        control.append( 'chr1\t%s\t%s\t%s\t%.2f\t+\n' % (start, start + 1, random.randint(10, 40), control_meth) )
+        affected.append( 'chr1\t%s\t%s\t%s\t%.2f\t+\n' % (start, start + 1, random.randint(10, 40), affected_meth) )
+    return control, affected
+
+
+class TestBHQvalues(unittest.TestCase):
+
+    def assertWithinBin(self, pvalues):
+        exact = exact_qvalues( pvalues )
+        binned = binned_qvalues( pvalues )
+        # the largest pvalue of each bin makes the binned qvalues conservative
+        self.assertTrue( (binned >= exact).all() )
+        self.assertTrue( (binned <= exact * (1 + BIN_WIDTH) + len(exact) * SUBNORMAL_BIN_WIDTH).all() )
+
+    def test_random_pvalues(self):
+        for seed in xrange(1, 6):
+            random_state = np.random.RandomState( seed )
+            self.assertWithinBin( random_state.uniform( 0, 1, 5000 ) ** 4 )
+
+    def test_ties_and_borders(self):
+        pvalues = [0.0, 0.0, 1e-30, 0.01, 0.01, 0.01, 0.04, 0.5, 1.0, 1.0]
+        self.assertWithinBin( pvalues )
+        self.assertEqual( binned_qvalues( pvalues )[-1], 1.0 )
+
+    def test_bin_edges(self):
+        # pvalues that are the largest value of their bins give the exact qvalues
+        bins = np.sort( np.random.RandomState( 1 ).choice( PVALUE_BINS - 1, 1000, replace=False ) )
+        pvalues = (((bins + 1) << 12) - 1).astype( np.uint32 ).view( np.float32 ).astype( float )
+        self.assertEqual( binned_qvalues( pvalues ).tolist(), exact_qvalues( pvalues ).tolist() )
+
+
+class TestFdrFiltering(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.directory )
+
+    def test_qvalue_file(self):
+        control, affected = random_lines( 7 )
+        filtered, qvalue_lines = filter_files( self.directory, control, affected, min_cov = 15, fdr = 0.05 )
+        # exact qvalues of all sites that are tested, i.e. pass --min-coverage
+        tested = [index for index in xrange( len(control) ) if int(control[index].split('\t')[3]) >= 15 and int(affected[index].split('\t')[3]) >= 15]
+        columns = [np.array( [float(lines[index].split('\t')[column]) for index in tested] ) for lines, column in [(control, 3), (control, 4), (affected, 3), (affected, 4)]]
+        exact = dict( zip( tested, exact_qvalues( fisher_pvalues( *columns ) ) ) )
+        passed = [int(line.split('\t')[1]) // 10 for line in filtered]
+        # all sites clearly below the --fdr pass, sites within one bin width above it may pass as well
+        self.assertTrue( passed )
+        self.assertEqual( [index for index in passed if exact[index] > 0.05], [] )
+        self.assertEqual( [index for index in tested if exact[index] <= 0.05 / (1 + BIN_WIDTH) and index not in passed], [] )
+
+        self.assertEqual( len(qvalue_lines), len(filtered) )
+        for index, line in zip( passed, qvalue_lines ):
+            qvalue = float( line.split('\t')[4] )
+            self.assertTrue( exact[index] * (1 - 1e-6) <= qvalue <= exact[index] * (1 + BIN_WIDTH + 1e-6) )
+
+
+class TestJoin(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree( self.directory )
+
+    def test_join(self):
+        control, affected, control_common, affected_common = site_files( 3 )
+        for arguments in [dict( min_cov = 5 ), dict( min_cov = 5, max_pvalue = 0.05 ), dict( fdr = 0.1 )]:
+            expected = filter_both( self.directory, control_common, affected_common, **arguments )
+            self.assertTrue( expected[0] )
+            for processors in [1, 2]:
+                self.assertEqual( filter_both( self.directory, control, affected, join = True, processors = processors, **arguments ), expected )
+
+    def test_chrom_order(self):
+        chrom_order = ['chr2', 'chr10', 'chr1']
+        control, affected, control_common, affected_common = site_files( 4, chrom_order )
+        expected = filter_both( self.directory, control_common, affected_common, min_cov = 5 )
+        self.assertEqual( filter_both( self.directory, control, affected, min_cov = 5, join = True, chrom_order = chrom_order ), expected )
+
+
+if __name__ == '__main__':
+    unittest.main()
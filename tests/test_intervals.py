@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import random
+import unittest
+import tempfile
+import shutil
+from methtools.intervals import IntervalIndex, annotation_argument
+
+__doc__ = """
+    The binary searches of IntervalIndex need to find the same overlapping
+    and nearest features as a linear scan over all features, also for
+    nested and long features that reach over many shorter ones.
+
+    Run all tests from the top directory of the repository with
+        python -m unittest discover tests
+"""
+
+
+def random_features(seed, count = 300):
+    """
+        Returns (chrom, start, end, name) tuples of short features and a few
+        long ones that span many of them.
+    """
+    random.seed( seed )
+    features = list()
+    for index in xrange( count ):
+        chrom = random.choice( ['chr1', 'chr2'] )
+        start = random.randint( 0, 100000 )
+        length = random.choice( [random.randint(1, 500)] * 9 + [random.randint(1000, 30000)] )
+        features.append( (chrom, start, start + length, 'feature%s' % index) )
+    return features
+
+
+def write_features(path, features):
+    with open(path, 'w') as handle:
+        handle.write( 'track name=features\n#chrom\tstart\tend\tname\n' )
+        for chrom, start, end, name in features:
+            handle.write( '%s\t%s\t%s\t%s\n' % (chrom, start, end, name) )
+
+
+class TestIntervalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join( self.directory, 'promoters.bed' )
+
+    def tearDown(self):
+        shutil.rmtree( self.directory )
+
+    def test_linear_scan(self):
+        for seed in xrange(1, 4):
+            features = random_features( seed )
+            write_features( self.path, features )
+            index = IntervalIndex( self.path )
+            self.assertEqual( len(index), len(features) )
+            for query in xrange( 300 ):
+                chrom = random.choice( ['chr1', 'chr2'] )
+                start = random.randint( 0, 110000 )
+                end = start + random.randint( 1, 2000 )
+                chrom_features = sorted( (feature_start, feature_end, name) for feature_chrom, feature_start, feature_end, name in features if feature_chrom == chrom )
+
+                overlapping = [name for feature_start, feature_end, name in chrom_features if feature_start < end and feature_end > start]
+                self.assertEqual( index.overlapping( chrom, start, end ), overlapping )
+
+                distances = dict( (name, max( feature_start - end, start - feature_end, 0 )) for feature_start, feature_end, name in chrom_features )
+                name, distance = index.nearest( chrom, start, end )
+                self.assertEqual( distance, min( distances.values() ) )
+                self.assertEqual( distances[name], distance )
+                if overlapping:
+                    self.assertEqual( name, overlapping[0] )
+
+    def test_annotate(self):
+        write_features( self.path, [('chr1', 100, 200, 'a'), ('chr1', 150, 400, 'b'), ('chr1', 1000, 1100, ''), ('chr2', 50, 60, 'c')] )
+        index = IntervalIndex( self.path )
+        self.assertEqual( index.name, 'promoters' )
+        self.assertEqual( index.annotate( 'chr1', 180, 190 ), 'a,b\ta\t0' )
+        # the intervals are half-open, a feature that ends at the start does not overlap
+        self.assertEqual( index.annotate( 'chr1', 400, 450 ), '.\tb\t0' )
+        # features without a name are named by their position
+        self.assertEqual( index.annotate( 'chr1', 900, 950 ), '.\tchr1:1000-1100\t50' )
+        self.assertEqual( index.annotate( 'chrX', 0, 10 ), '.\t.\t.' )
+
+    def test_annotation_argument(self):
+        self.assertEqual( annotation_argument( 'cpg=/data/islands.bed' ), ('cpg', '/data/islands.bed') )
+        self.assertEqual( annotation_argument( '/data/islands.bed' ), ('islands', '/data/islands.bed') )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import random
+import unittest
+import StringIO
+import numpy as np
+from methtools.sites import SiteBlock, read_blocks, intersected_blocks, joined_lines
+
+__doc__ = """
+    Reading BED6 files in blocks of sites, the columns of a SiteBlock, the
+    alignment of the blocks of intersected files and the --join of files
+    that are not intersected.
+
+    Run all tests from the top directory of the repository with
+        python -m unittest discover tests
+"""
+
+LINES = [
+    'chr1\t10\t11\t14\t85.71\t-\n',
+    'chr1\t20\t21\t30\t6.67\t+\n',
+    'chr2\t5\t6\t3\t100.00\t+\r\n',
+]
+
+
+class TestSiteBlock(unittest.TestCase):
+
+    def test_columns(self):
+        block = SiteBlock( LINES )
+        self.assertEqual( block.chrom, ['chr1', 'chr1', 'chr2'] )
+        self.assertEqual( block.strand, ['-', '+', '+'] )
+        self.assertEqual( block.start.tolist(), [10, 20, 5] )
+        self.assertEqual( block.end.dtype, np.int64 )
+        self.assertEqual( block.cov.tolist(), [14.0, 30.0, 3.0] )
+        self.assertEqual( block.meth.tolist(), [85.71, 6.67, 100.0] )
+
+    def test_invalid_number(self):
+        block = SiteBlock( ['chr1\t10\t11\tn/a\t85.71\t-\n'] )
+        self.assertRaises( ValueError, getattr, block, 'cov' )
+
+    def test_missing_column(self):
+        self.assertRaises( SystemExit, SiteBlock, ['chr1\t10\t11\t14\t85.71\n'] )
+
+    def test_subset(self):
+        block = SiteBlock( LINES )
+        block.cov
+        for index in [slice(1, None), np.array([True, False, True])]:
+            subset = block.subset( index )
+            expected = SiteBlock( np.array(LINES)[index].tolist() )
+            self.assertEqual( subset.lines, expected.lines )
+            self.assertEqual( subset.chrom, expected.chrom )
+            self.assertEqual( subset.cov.tolist(), expected.cov.tolist() )
+            self.assertEqual( subset.meth.tolist(), expected.meth.tolist() )
+
+    def test_first_difference(self):
+        block = SiteBlock( LINES )
+        self.assertEqual( block.first_difference( SiteBlock( LINES ) ), None )
+        # coverage and methylation are not compared
+        self.assertEqual( block.first_difference( SiteBlock( [LINES[0], 'chr1\t20\t21\t8\t50.00\t+\n', LINES[2]] ) ), None )
+        self.assertEqual( block.first_difference( SiteBlock( [LINES[0], LINES[1], 'chr2\t5\t6\t3\t100.00\t-\n'] ) ), 2 )
+        self.assertEqual( block.first_difference( SiteBlock( [LINES[0], 'chr1\t21\t22\t30\t6.67\t+\n', LINES[2]] ) ), 1 )
+
+
+class TestReadBlocks(unittest.TestCase):
+
+    def test_header_lines(self):
+        lines = ['#genome chr1 100\n'] + LINES[:2] + ['\n', '# comment\n'] + LINES[2:]
+        blocks = list( read_blocks( iter(lines), block_size = 2 ) )
+        self.assertEqual( [len(block) for block in blocks], [2, 1] )
+        self.assertEqual( sum( (block.lines for block in blocks), [] ), LINES )
+
+    def test_intersected_blocks(self):
+        # the header lines of one file shift its blocks, the sites are still aligned
+        control = StringIO.StringIO( ''.join( ['#track\n', '#genome\n'] + LINES * 3 ) )
+        affected = StringIO.StringIO( ''.join( LINES * 3 ) )
+        pairs = list( intersected_blocks( [control, affected], block_size = 4 ) )
+        self.assertEqual( sum( len(first) for first, second in pairs ), 9 )
+        for first, second in pairs:
+            self.assertEqual( first.lines, second.lines )
+
+    def test_not_intersected(self):
+        control = StringIO.StringIO( ''.join( LINES ) )
+        affected = StringIO.StringIO( ''.join( LINES[:1] + LINES[2:] ) )
+        self.assertRaises( SystemExit, list, intersected_blocks( [control, affected] ) )
+
+
+def site_files(seed, chrom_order = None, count = 300):
+    """
+        Returns the lines of a sorted control and affected file with sites
+        that are only present in one of them, and the lines of both files
+        intersected to the common sites, as bedtools intersect writes them.
+        The files are sorted in chrom_order or lexicographic.
+    """
+    random.seed( seed )
+    control = list()
+    affected = list()
+    control_common = list()
+    affected_common = list()
+    for chrom in chrom_order or sorted( ['chr1', 'chr2', 'chr10'] ):
+        for index in xrange( count ):
+            # the CpG on the forward strand and its neighbour on the reverse strand
+            for start, strand in [(index * 10, '+'), (index * 10 + 1, '-')]:
+                lines = ['%s\t%s\t%s\t%s\t%.2f\t%s\n' % (chrom, start, start + 1, random.randint(1, 30), random.uniform(0, 100), strand) for sample in xrange(2)]
+                present = random.choice( ['both', 'both', 'both', 'control', 'affected'] )
+                if present != 'affected':
+                    control.append( lines[0] )
+                if present != 'control':
+                    affected.append( lines[1] )
+                if present == 'both':
+                    control_common.append( lines[0] )
+                    affected_common.append( lines[1] )
+    return control, affected, control_common, affected_common
+
+
+class TestJoinedLines(unittest.TestCase):
+
+    def test_intersected(self):
+        control, affected, control_common, affected_common = site_files( 1 )
+        joined = list( joined_lines( [iter(control), iter(affected)] ) )
+        self.assertEqual( joined, zip( control_common, affected_common ) )
+
+    def test_chrom_order(self):
+        chrom_order = ['chr2', 'chr10', 'chr1']
+        control, affected, control_common, affected_common = site_files( 2, chrom_order )
+        self.assertEqual( list( joined_lines( [iter(control), iter(affected)], chrom_order ) ), zip( control_common, affected_common ) )
+        # in lexicographic order the files are not sorted
+        self.assertRaises( SystemExit, list, joined_lines( [iter(control), iter(affected)] ) )
+
+    def test_strand_order(self):
+        # both strands of one start position, in a different order in each file
+        control = ['chr1\t10\t11\t5\t50.00\t+\n', 'chr1\t10\t11\t6\t60.00\t-\n', 'chr1\t20\t21\t7\t70.00\t-\n']
+        affected = [control[1], control[0], 'chr1\t20\t21\t7\t70.00\t+\n']
+        self.assertEqual( list( joined_lines( [iter(control), iter(affected)] ) ), [(control[0], control[0]), (control[1], control[1])] )
+
+    def test_unsorted(self):
+        control = ['chr1\t20\t21\t5\t50.00\t+\n', 'chr1\t10\t11\t6\t60.00\t+\n']
+        self.assertRaises( SystemExit, list, joined_lines( [iter(control), iter(control)] ) )
+
+
+if __name__ == '__main__':
+    unittest.main()